@@ -1,11 +1,18 @@
 import logging
+import os
+import pickle
+import posixpath
+import shutil
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
 from functools import partial
 
 import fiona
 import pyproj
 import shapely.ops as ops
 from fiona.transform import transform_geom
-from shapely.geometry import mapping
 from shapely.geometry import MultiPolygon
 from shapely.geometry import Polygon
 from shapely.geometry import shape
@@ -13,10 +20,62 @@ from shapely.geometry.polygon import orient
 
 import geoutils
 import utils
+from columnar import FeatureStoreBuilder
+from instrumentation import SourceStats
 from merge import merge_features
 from property_transformation import get_transformed_properties
 from property_transformation import PropertyMappingFailedException
 
+# number of temporary files features are spilled to when merging in
+# iter_features, each file is merged in memory on its own
+SPILL_BUCKETS = 64
+# number of features iter_features computes the areas of at once
+AREA_BATCH_SIZE = 1000
+
+
+@contextmanager
+def open_archive_dataset(archive_path, member, members=None, layer=None):
+    """Open a dataset in an archive as a fiona collection.
+
+    The dataset is read in place through GDAL's virtual file systems if the
+    archive format supports it. Otherwise only the members it is made of are
+    extracted.
+
+    :param archive_path: string
+    :param member: string, name of the dataset in the archive
+    :param members: list of the names of the members the dataset is made of,
+        defaults to member
+    :param layer: string, layer of the dataset to open
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        source = None
+        vsi = utils.get_archive_vsi(archive_path)
+        if vsi is not None:
+            scheme, extension = vsi
+            try:
+                # GDAL only recognizes archives by their extension
+                link = os.path.join(tmp_dir, "archive" + extension)
+                os.symlink(os.path.abspath(archive_path), link)
+                source = fiona.open(
+                    "/" + posixpath.normpath(member),
+                    vfs=scheme + "://" + link,
+                    layer=layer,
+                )
+            except Exception as e:
+                logging.warning(
+                    "Unable to read %s in place, extracting it: %s" % (member, e)
+                )
+
+        if source is None:
+            utils.extract_members(archive_path, members or [member], tmp_dir)
+            source = fiona.open(os.path.join(tmp_dir, member), layer=layer)
+
+        with source:
+            yield source
+    finally:
+        shutil.rmtree(tmp_dir)
+
 
 def _force_geometry_2d(geometry):
     """ Convert a geometry to 2d
@@ -44,102 +103,347 @@ def _force_linestring_2d(linestring):
 
 
 def _force_geometry_ccw(geometry):
-    if geometry["type"] == "Polygon":
-        return _force_polygon_ccw(geometry)
-    elif geometry["type"] == "MultiPolygon":
-        oriented_polygons = [
-            _force_polygon_ccw({"type": "Polygon", "coordinates": g})
-            for g in geometry["coordinates"]
-        ]
-        geometry["coordinates"] = [g["coordinates"] for g in oriented_polygons]
-        return geometry
+    if type(geometry) == Polygon:
+        return orient(geometry)
+    elif type(geometry) == MultiPolygon:
+        return MultiPolygon([orient(g) for g in geometry.geoms])
     else:
         return geometry
 
 
-def _force_polygon_ccw(geometry):
-    polygon = shape(geometry)
-    return mapping(orient(polygon))
-
+def _fix_geometry(shapely_geometry):
+    """Returns a shapely geometry fixed if it is invalid, and whether it is
+    valid, None if that is not known."""
+    if shapely_geometry.is_valid:
+        return shapely_geometry, True
+    buffered = shapely_geometry.buffer(0.0)
+    # this will fix some invalid geometries, including bow-tie geometries, but for others it will return an empty geometry
+    if buffered and (
+        (type(buffered) == Polygon and buffered.exterior)
+        or (type(buffered) == MultiPolygon and len(buffered.geoms) > 0)
+    ):
+        return buffered, None
+    return shapely_geometry, False
 
-def _fix_geometry(geometry):
-    shapely_geometry = shape(geometry)
-    if not shapely_geometry.is_valid:
-        buffered = shapely_geometry.buffer(0.0)
-        # this will fix some invalid geometries, including bow-tie geometries, but for others it will return an empty geometry
-        if buffered and (
-            (type(buffered) == Polygon and buffered.exterior)
-            or (type(buffered) == MultiPolygon and len(buffered.geoms) > 0)
-        ):
-            return mapping(buffered)
-    return geometry
 
+def _iter_transformed(
+    source, prop_map, filterer, merge_on, stats, counts, spatial_filter=None
+):
+    """Yields the features of a fiona collection that pass the filters,
+    reprojected, fixed, clipped, oriented and with their properties mapped.
 
-def read_fiona(source, prop_map, filterer=None, merge_on=None):
-    """Process a fiona collection
+    :param counts: dict, the skipped, kept and failed feature counts are added
+        to it
+    :param spatial_filter: filters.SpatialFilter
     """
-    collection = {
-        "type": "FeatureCollection",
-        "features": [],
-        "bbox": [float("inf"), float("inf"), float("-inf"), float("-inf")],
-    }
-    skipped_count = 0
-    failed_count = 0
+    reproject_wall = 0.0
+    reproject_cpu = 0.0
     transformer = partial(
         transform_geom, source.crs, "EPSG:4326", antimeridian_cutting=True, precision=6
     )
 
-    for feature in source:
+    features, total = _filter_source(source, spatial_filter)
+    read = 0
+    for feature in features:
+        read += 1
         if filterer is not None and not filterer.keep(feature):
-            skipped_count += 1
+            counts["skipped"] += 1
             continue
         if feature["geometry"] is None:
             logging.error("empty geometry")
-            failed_count += 1
+            counts["failed"] += 1
             continue
+        feature = geoutils.Feature(feature)
         try:
+            start_wall = time.perf_counter()
+            start_cpu = time.process_time()
             transformed_geometry = transformer(_force_geometry_2d(feature["geometry"]))
-            fixed_geometry = _fix_geometry(transformed_geometry)
-            feature["geometry"] = _force_geometry_ccw(fixed_geometry)
+            fixed_geometry, is_valid = _fix_geometry(shape(transformed_geometry))
+            if spatial_filter is not None:
+                clipped = spatial_filter.filter_shape(fixed_geometry)
+                if clipped is not fixed_geometry:
+                    fixed_geometry, is_valid = clipped, None
+            if fixed_geometry is not None:
+                feature.set_shape(_force_geometry_ccw(fixed_geometry), is_valid)
+            reproject_wall += time.perf_counter() - start_wall
+            reproject_cpu += time.process_time() - start_cpu
+            if fixed_geometry is None:
+                counts["skipped"] += 1
+                continue
 
             if merge_on:
                 feature["original_properties"] = feature["properties"]
             feature["properties"] = get_transformed_properties(
                 feature["properties"], prop_map
             )
-            collection["features"].append(feature)
         except PropertyMappingFailedException as e:
             logging.error(str(e) + ": " + str(feature["properties"]))
-            failed_count += 1
+            counts["failed"] += 1
+            continue
         except Exception as e:
             logging.exception("Error processing feature: " + str(feature))
-            failed_count += 1
+            counts["failed"] += 1
+            continue
+        counts["kept"] += 1
+        yield feature
 
-    pre_merge_count = len(collection["features"])
-    if merge_on:
-        collection = merge_features(
-            collection, merge_on, properties_key="original_properties"
+    if total is not None and total >= read:
+        counts["skipped"] += total - read
+    stats.record(
+        "read.reproject", reproject_wall, reproject_cpu, features=counts["kept"]
+    )
+
+
+def _filter_source(source, spatial_filter=None):
+    """Returns an iterator over the features of a fiona collection, with the
+    spatial filter pushed down to OGR, so the features it rejects are never
+    decoded. Features still have to be tested with the spatial filter.
+
+    :returns: the iterator, and the number of features in the collection if
+        the spatial filter was pushed down, None otherwise
+    """
+    if spatial_filter is None:
+        return iter(source), None
+    try:
+        source_filter = spatial_filter.get_source_filter(source.crs)
+    except Exception as e:
+        logging.warning(
+            "Unable to reproject the spatial filter, reading every feature: %s" % e
         )
+        return iter(source), None
+    # count before the filter is set on the layer
+    total = len(source)
+    return source.filter(**source_filter), total
 
-    for feature in collection["features"]:
+
+def _finish_features(features):
+    """Add the area, bounding box and id of features."""
+    areas = geoutils.get_areas_acres([feature["geometry"] for feature in features])
+    for feature, area in zip(features, areas):
         if "original_properties" in feature:
             del feature["original_properties"]
-        feature["properties"]["acres"] = geoutils.get_area_acres(feature["geometry"])
+        feature["properties"]["acres"] = area
         feature["bbox"] = geoutils.get_bbox_from_geojson_feature(feature)
         if "id" in feature["properties"]:
             feature["id"] = feature["properties"]["id"]
 
-    if len(collection["features"]) > 0:
-        collection["bbox"] = geoutils.get_bbox_from_geojson(collection)
 
+def _finish_feature_store(store):
+    """Add the area, bounding box and id of the features of a
+    columnar.FeatureStore, like _finish_features."""
+    store.set_property("acres", geoutils.get_feature_store_areas_acres(store))
+    store.set_bboxes(store.get_bboxes())
+    features = store.get_features_with_property("id")
+    ids = store.get_property("id")
+    store.set_member("id", [ids[i] for i in features], features)
+
+
+def _build_feature_store(features):
+    """Returns a columnar.FeatureStore of features, consuming them one at a
+    time."""
+    builder = FeatureStoreBuilder()
+    for feature in features:
+        if "original_properties" in feature:
+            del feature["original_properties"]
+        builder.append(feature, geoutils.as_feature(feature).is_valid)
+    return builder.build()
+
+
+def _new_counts():
+    return {"skipped": 0, "kept": 0, "failed": 0, "output": 0}
+
+
+def _log_counts(counts):
     logging.info(
         "skipped %i features, kept %i features, merged %i features, errored %i features"
         % (
-            skipped_count,
-            pre_merge_count,
-            pre_merge_count - len(collection["features"]),
-            failed_count,
+            counts["skipped"],
+            counts["kept"],
+            counts["kept"] - counts["output"],
+            counts["failed"],
         )
     )
 
+
+def read_fiona(
+    source,
+    prop_map,
+    filterer=None,
+    merge_on=None,
+    stats=None,
+    columnar=False,
+    processes=1,
+    merge_adjacent_only=False,
+    spatial_filter=None,
+):
+    """Process a fiona collection
+
+    :param columnar: bool, collect the features in a columnar.FeatureStore
+        instead of a list of dicts. They are packed as they are read, or once
+        merged if merge_on is set
+    :param processes: int, number of processes to merge large groups of
+        features in
+    :param merge_adjacent_only: bool, only merge features that touch or
+        overlap
+    :param spatial_filter: filters.SpatialFilter, only read the features
+        intersecting its area
+    """
+    if stats is None:
+        stats = SourceStats(None)
+    collection = {
+        "type": "FeatureCollection",
+        "features": [],
+        "bbox": [float("inf"), float("inf"), float("-inf"), float("-inf")],
+    }
+    counts = _new_counts()
+    features = _iter_transformed(
+        source, prop_map, filterer, merge_on, stats, counts, spatial_filter
+    )
+    if columnar and not merge_on:
+        collection["features"] = _build_feature_store(features)
+    else:
+        collection["features"] = list(features)
+
+    pre_merge_count = len(collection["features"])
+    if merge_on:
+        with stats.stage("read.merge") as stage_counts:
+            collection = merge_features(
+                collection,
+                merge_on,
+                properties_key="original_properties",
+                processes=processes,
+                adjacent_only=merge_adjacent_only,
+            )
+            stage_counts["features"] = pre_merge_count
+        if columnar:
+            collection["features"] = _build_feature_store(collection["features"])
+
+    with stats.stage("read.area") as stage_counts:
+        if columnar:
+            _finish_feature_store(collection["features"])
+        else:
+            _finish_features(collection["features"])
+        stage_counts["features"] = len(collection["features"])
+
+    if len(collection["features"]) > 0:
+        collection["bbox"] = geoutils.get_bbox_from_geojson(collection)
+
+    counts["output"] = len(collection["features"])
+    _log_counts(counts)
+
     return collection
+
+
+def iter_features(
+    source,
+    prop_map,
+    filterer=None,
+    merge_on=None,
+    stats=None,
+    processes=1,
+    merge_adjacent_only=False,
+    spatial_filter=None,
+):
+    """Process a fiona collection, yielding the processed features one at a
+    time instead of collecting them in memory.
+
+    Merging needs every feature sharing a merge value at once, so features are
+    spilled to temporary files bucketed by merge value and each bucket is
+    merged in turn. Merged features are yielded bucket by bucket, so their
+    order differs from read_fiona.
+    """
+    if stats is None:
+        stats = SourceStats(None)
+    counts = _new_counts()
+    features = _iter_transformed(
+        source, prop_map, filterer, merge_on, stats, counts, spatial_filter
+    )
+    if merge_on:
+        features = _spill_merge(
+            features, merge_on, stats, processes, merge_adjacent_only
+        )
+
+    area_wall = 0.0
+    area_cpu = 0.0
+    for batch in _iter_batches(features, AREA_BATCH_SIZE):
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        _finish_features(batch)
+        area_wall += time.perf_counter() - start_wall
+        area_cpu += time.process_time() - start_cpu
+        counts["output"] += len(batch)
+        yield from batch
+
+    stats.record("read.area", area_wall, area_cpu, features=counts["output"])
+    _log_counts(counts)
+
+
+def _iter_batches(features, size):
+    batch = []
+    for feature in features:
+        batch.append(feature)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _spill_merge(features, merge_on, stats, processes=1, adjacent_only=False):
+    """Merge features on a property, holding only the features of one bucket
+    of merge values in memory at a time.
+
+    :param features: iterable of features with original_properties
+    :param merge_on: string, property to merge on
+    :param stats: instrumentation.SourceStats
+    :param processes: int, number of processes to merge large groups in
+    :param adjacent_only: bool, only merge features that touch or overlap
+    :yields: merged features
+    """
+    spill_dir = tempfile.mkdtemp()
+    try:
+        with stats.stage("read.spill") as counts:
+            buckets = [
+                open(os.path.join(spill_dir, "%i.pickle" % i), "wb")
+                for i in range(SPILL_BUCKETS)
+            ]
+            count = 0
+            for feature in features:
+                # a stable hash, so features are merged in the same order
+                # in every run
+                value = repr(feature["original_properties"][merge_on])
+                pickle.dump(
+                    feature,
+                    buckets[zlib.crc32(value.encode()) % SPILL_BUCKETS],
+                    pickle.HIGHEST_PROTOCOL,
+                )
+                count += 1
+            for bucket in buckets:
+                bucket.close()
+            counts["features"] = count
+
+        for bucket in buckets:
+            bucket_features = []
+            with open(bucket.name, "rb") as f:
+                while True:
+                    try:
+                        bucket_features.append(pickle.load(f))
+                    except EOFError:
+                        break
+            os.remove(bucket.name)
+            if not bucket_features:
+                continue
+
+            with stats.stage("read.merge") as counts:
+                merged = merge_features(
+                    {"type": "FeatureCollection", "features": bucket_features},
+                    merge_on,
+                    properties_key="original_properties",
+                    processes=processes,
+                    adjacent_only=adjacent_only,
+                )
+                counts["features"] = len(bucket_features)
+            del bucket_features
+            yield from merged["features"]
+    finally:
+        shutil.rmtree(spill_dir)
@@ -1,31 +1,28 @@
 import os
-import shutil
-import tempfile
 import zipfile
-
-import fiona
+from contextlib import contextmanager
 
 from . import fiona_dataset
 from utils import get_compressed_file_wrapper
 
 
-def read(
-    fp, prop_map, filterer=None, source_filename=None, layer_name=None, merge_on=None
-):
-    """Read FileGeoDatabase.
+@contextmanager
+def open_dataset(fp, source_filename=None, layer_name=None):
+    """Open a layer of the FileGeoDatabase in a zip file as a fiona collection.
 
     :param fp: file-like object
-    :param prop_map: dictionary mapping source properties to output properties
     :param source_filename: Filename to read, only applicable if fp is a zip file
+    :param layer_name: Layer of the FileGeoDatabase to read
     """
-    # search for a shapefile in the zip file, unzip if found
-    unzip_dir = tempfile.mkdtemp(suffix=".gdb")
+    # search for a .gdb directory in the zip file
     gdb_name = source_filename
     zipped_file = get_compressed_file_wrapper(fp.name)
+    names = zipped_file.namelist()
+    zipped_file.close()
 
     if gdb_name is None:
-        for name in zipped_file.infolist():
-            dirname = os.path.dirname(name.filename)
+        for name in names:
+            dirname = os.path.dirname(name)
             base, ext = os.path.splitext(dirname)
             if ext == ".gdb":
                 if gdb_name is not None and gdb_name != dirname:
@@ -37,15 +34,90 @@ def read(
                 "Unabled to find .gdb directory in zipfile, and filenameInZip not set"
             )
 
-    zipped_file.extractall(unzip_dir)
-    zipped_file.close()
+    gdb_name = gdb_name.rstrip("/")
+    members = [name for name in names if name.startswith(gdb_name + "/")]
+
+    # Open the FileGeoDatabase
+    with fiona_dataset.open_archive_dataset(
+        fp.name, gdb_name, members, layer=layer_name
+    ) as source:
+        yield source
+
+
+def read(
+    fp,
+    prop_map,
+    filterer=None,
+    source_filename=None,
+    layer_name=None,
+    merge_on=None,
+    stats=None,
+    columnar=False,
+    processes=1,
+    merge_adjacent_only=False,
+    spatial_filter=None,
+):
+    """Read FileGeoDatabase.
 
-    # Open the shapefile
-    with fiona.open(os.path.join(unzip_dir, gdb_name), layer=layer_name) as source:
-        collection = fiona_dataset.read_fiona(
-            source, prop_map, filterer, merge_on=merge_on
+    :param fp: file-like object
+    :param prop_map: dictionary mapping source properties to output properties
+    :param source_filename: Filename to read, only applicable if fp is a zip file
+    :param stats: instrumentation.SourceStats to record stage timings to
+    :param columnar: bool, return the features as a columnar.FeatureStore
+    :param processes: int, number of processes to merge large groups of
+        features in
+    :param merge_adjacent_only: bool, only merge features that touch or
+        overlap
+    :param spatial_filter: filters.SpatialFilter, only read the features
+        intersecting its area
+    """
+    with open_dataset(fp, source_filename, layer_name) as source:
+        return fiona_dataset.read_fiona(
+            source,
+            prop_map,
+            filterer,
+            merge_on=merge_on,
+            stats=stats,
+            columnar=columnar,
+            processes=processes,
+            merge_adjacent_only=merge_adjacent_only,
+            spatial_filter=spatial_filter,
         )
 
-    shutil.rmtree(unzip_dir)
 
-    return collection
+def stream(
+    fp,
+    prop_map,
+    filterer=None,
+    source_filename=None,
+    layer_name=None,
+    merge_on=None,
+    stats=None,
+    processes=1,
+    merge_adjacent_only=False,
+    spatial_filter=None,
+):
+    """Read FileGeoDatabase, yielding features one at a time.
+
+    :param fp: file-like object
+    :param prop_map: dictionary mapping source properties to output properties
+    :param source_filename: Filename to read, only applicable if fp is a zip file
+    :param stats: instrumentation.SourceStats to record stage timings to
+    :param processes: int, number of processes to merge large groups of
+        features in
+    :param merge_adjacent_only: bool, only merge features that touch or
+        overlap
+    :param spatial_filter: filters.SpatialFilter, only read the features
+        intersecting its area
+    """
+    with open_dataset(fp, source_filename, layer_name) as source:
+        yield from fiona_dataset.iter_features(
+            source,
+            prop_map,
+            filterer,
+            merge_on=merge_on,
+            stats=stats,
+            processes=processes,
+            merge_adjacent_only=merge_adjacent_only,
+            spatial_filter=spatial_filter,
+        )
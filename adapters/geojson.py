@@ -1,6 +1,5 @@
 import os
-import shutil
-import tempfile
+from contextlib import contextmanager
 
 import fiona
 
@@ -8,48 +7,118 @@ from . import fiona_dataset
 from utils import get_compressed_file_wrapper
 
 
-def read(
-    fp, prop_map, filterer=None, source_filename=None, layer_name=None, merge_on=None
-):
-    """Read geojson file.
+@contextmanager
+def open_dataset(fp, source_filename=None, layer_name=None):
+    """Open a geojson file, or the geojson file in a zip file, as a fiona
+    collection.
 
     :param fp: file-like object
-    :param prop_map: dictionary mapping source properties to output properties
     :param source_filename: Filename to read, only applicable if fp is a zip file
     """
     filename = os.path.basename(fp.name)
     root, ext = os.path.splitext(filename)
 
-    unzip_dir = tempfile.mkdtemp()
-
     if ext == ".geojson" or ext == ".json":
-        file_to_process = fp.name
-    else:
-        # search for a geojson file in the zip file, unzip if found
-        shp_name = source_filename
+        with fiona.open(fp.name) as source:
+            yield source
+        return
+
+    # search for a geojson file in the zip file
+    shp_name = source_filename
+    if shp_name is None:
         zipped_file = get_compressed_file_wrapper(fp.name)
+        names = zipped_file.namelist()
+        zipped_file.close()
+
+        for name in names:
+            base, ext = os.path.splitext(name)
+            if ext == ".geojson":
+                if shp_name is not None:
+                    raise Exception("Found multiple shapefiles in zipfile")
+                shp_name = name
 
         if shp_name is None:
-            for name in zipped_file.infolist():
-                base, ext = os.path.splitext(name.filename)
-                if ext == ".geojson":
-                    if shp_name is not None:
-                        raise Exception("Found multiple shapefiles in zipfile")
-                    shp_name = name.filename
+            raise Exception("Found 0 shapefiles in zipfile")
 
-            if shp_name is None:
-                raise Exception("Found 0 shapefiles in zipfile")
+    # Open the geojson file
+    with fiona_dataset.open_archive_dataset(fp.name, shp_name) as source:
+        yield source
 
-        zipped_file.extractall(unzip_dir)
-        zipped_file.close()
-        file_to_process = os.path.join(unzip_dir, shp_name)
 
-    # Open the shapefile
-    with fiona.open(file_to_process) as source:
-        collection = fiona_dataset.read_fiona(
-            source, prop_map, filterer, merge_on=merge_on
+def read(
+    fp,
+    prop_map,
+    filterer=None,
+    source_filename=None,
+    layer_name=None,
+    merge_on=None,
+    stats=None,
+    columnar=False,
+    processes=1,
+    merge_adjacent_only=False,
+    spatial_filter=None,
+):
+    """Read geojson file.
+
+    :param fp: file-like object
+    :param prop_map: dictionary mapping source properties to output properties
+    :param source_filename: Filename to read, only applicable if fp is a zip file
+    :param stats: instrumentation.SourceStats to record stage timings to
+    :param columnar: bool, return the features as a columnar.FeatureStore
+    :param processes: int, number of processes to merge large groups of
+        features in
+    :param merge_adjacent_only: bool, only merge features that touch or
+        overlap
+    :param spatial_filter: filters.SpatialFilter, only read the features
+        intersecting its area
+    """
+    with open_dataset(fp, source_filename, layer_name) as source:
+        return fiona_dataset.read_fiona(
+            source,
+            prop_map,
+            filterer,
+            merge_on=merge_on,
+            stats=stats,
+            columnar=columnar,
+            processes=processes,
+            merge_adjacent_only=merge_adjacent_only,
+            spatial_filter=spatial_filter,
         )
 
-    shutil.rmtree(unzip_dir)
 
-    return collection
+def stream(
+    fp,
+    prop_map,
+    filterer=None,
+    source_filename=None,
+    layer_name=None,
+    merge_on=None,
+    stats=None,
+    processes=1,
+    merge_adjacent_only=False,
+    spatial_filter=None,
+):
+    """Read geojson file, yielding features one at a time.
+
+    :param fp: file-like object
+    :param prop_map: dictionary mapping source properties to output properties
+    :param source_filename: Filename to read, only applicable if fp is a zip file
+    :param stats: instrumentation.SourceStats to record stage timings to
+    :param processes: int, number of processes to merge large groups of
+        features in
+    :param merge_adjacent_only: bool, only merge features that touch or
+        overlap
+    :param spatial_filter: filters.SpatialFilter, only read the features
+        intersecting its area
+    """
+    with open_dataset(fp, source_filename, layer_name) as source:
+        yield from fiona_dataset.iter_features(
+            source,
+            prop_map,
+            filterer,
+            merge_on=merge_on,
+            stats=stats,
+            processes=processes,
+            merge_adjacent_only=merge_adjacent_only,
+            spatial_filter=spatial_filter,
+        )
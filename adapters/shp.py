@@ -1,50 +1,120 @@
 import os
-import shutil
-import tempfile
-
-import fiona
+from contextlib import contextmanager
 
 from . import fiona_dataset
 from property_transformation import get_transformed_properties
 from utils import get_compressed_file_wrapper
 
 
-def read(
-    fp, prop_map, filterer=None, source_filename=None, layer_name=None, merge_on=None
-):
-    """Read shapefile.
+@contextmanager
+def open_dataset(fp, source_filename=None, layer_name=None):
+    """Open the shapefile in a zip file as a fiona collection.
 
     :param fp: file-like object
-    :param prop_map: dictionary mapping source properties to output properties
     :param source_filename: Filename to read, only applicable if fp is a zip file
     """
-    # search for a shapefile in the zip file, unzip if found
-    unzip_dir = tempfile.mkdtemp()
+    # search for a shapefile in the zip file
     shp_name = source_filename
     zipped_file = get_compressed_file_wrapper(fp.name)
+    names = zipped_file.namelist()
+    zipped_file.close()
 
     if shp_name is None:
-        for name in zipped_file.infolist():
-            base, ext = os.path.splitext(os.path.basename(name.filename))
+        for name in names:
+            base, ext = os.path.splitext(os.path.basename(name))
             if base.startswith("."):
                 continue
             if ext == ".shp":
                 if shp_name is not None:
                     raise Exception("Found multiple shapefiles in zipfile")
-                shp_name = name.filename
+                shp_name = name
 
         if shp_name is None:
             raise Exception("Found 0 shapefiles in zipfile")
 
-    zipped_file.extractall(unzip_dir)
-    zipped_file.close()
+    # the .shp file and its sidecar files, eg. .dbf and .prj
+    base, ext = os.path.splitext(shp_name)
+    members = [name for name in names if name.startswith(base + ".")]
 
     # Open the shapefile
-    with fiona.open(os.path.join(unzip_dir, shp_name)) as source:
-        collection = fiona_dataset.read_fiona(
-            source, prop_map, filterer, merge_on=merge_on
+    with fiona_dataset.open_archive_dataset(fp.name, shp_name, members) as source:
+        yield source
+
+
+def read(
+    fp,
+    prop_map,
+    filterer=None,
+    source_filename=None,
+    layer_name=None,
+    merge_on=None,
+    stats=None,
+    columnar=False,
+    processes=1,
+    merge_adjacent_only=False,
+    spatial_filter=None,
+):
+    """Read shapefile.
+
+    :param fp: file-like object
+    :param prop_map: dictionary mapping source properties to output properties
+    :param source_filename: Filename to read, only applicable if fp is a zip file
+    :param stats: instrumentation.SourceStats to record stage timings to
+    :param columnar: bool, return the features as a columnar.FeatureStore
+    :param processes: int, number of processes to merge large groups of
+        features in
+    :param merge_adjacent_only: bool, only merge features that touch or
+        overlap
+    :param spatial_filter: filters.SpatialFilter, only read the features
+        intersecting its area
+    """
+    with open_dataset(fp, source_filename, layer_name) as source:
+        return fiona_dataset.read_fiona(
+            source,
+            prop_map,
+            filterer,
+            merge_on=merge_on,
+            stats=stats,
+            columnar=columnar,
+            processes=processes,
+            merge_adjacent_only=merge_adjacent_only,
+            spatial_filter=spatial_filter,
         )
 
-    shutil.rmtree(unzip_dir)
 
-    return collection
+def stream(
+    fp,
+    prop_map,
+    filterer=None,
+    source_filename=None,
+    layer_name=None,
+    merge_on=None,
+    stats=None,
+    processes=1,
+    merge_adjacent_only=False,
+    spatial_filter=None,
+):
+    """Read shapefile, yielding features one at a time.
+
+    :param fp: file-like object
+    :param prop_map: dictionary mapping source properties to output properties
+    :param source_filename: Filename to read, only applicable if fp is a zip file
+    :param stats: instrumentation.SourceStats to record stage timings to
+    :param processes: int, number of processes to merge large groups of
+        features in
+    :param merge_adjacent_only: bool, only merge features that touch or
+        overlap
+    :param spatial_filter: filters.SpatialFilter, only read the features
+        intersecting its area
+    """
+    with open_dataset(fp, source_filename, layer_name) as source:
+        yield from fiona_dataset.iter_features(
+            source,
+            prop_map,
+            filterer,
+            merge_on=merge_on,
+            stats=stats,
+            processes=processes,
+            merge_adjacent_only=merge_adjacent_only,
+            spatial_filter=spatial_filter,
+        )
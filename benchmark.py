@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+import copy
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+import click
+import fiona
+from fiona.crs import from_epsg
+
+import adapters
+import geoutils
+import merge
+
+# number of features and vertices per polygon ring for each fixture scale
+SCALES = {
+    "small": {"features": 100, "vertices": 10},
+    "medium": {"features": 10000, "vertices": 10},
+    "large": {"features": 100000, "vertices": 10},
+    "complex": {"features": 100, "vertices": 10000},
+}
+
+VARIANTS = ["valid", "invalid", "multipart"]
+
+# area the synthetic features are scattered over, roughly Montana
+EXTENT = (-116.0, 44.5, -104.0, 49.0)
+
+MERGE_GROUPS = 10
+
+
+def _ring(x, y, radius, vertices, rng):
+    """Returns a closed ring of a jittered regular polygon around x, y."""
+    ring = []
+    for i in range(vertices):
+        angle = 2 * math.pi * i / vertices
+        r = radius * (0.8 + 0.2 * rng.random())
+        ring.append((x + r * math.cos(angle), y + r * math.sin(angle)))
+    ring.append(ring[0])
+    return ring
+
+
+def _bowtie(x, y, radius, vertices, rng):
+    """Returns a closed, self intersecting ring."""
+    half = max(vertices // 2, 2)
+    left = _ring(x - radius, y, radius, half, rng)[:-1]
+    right = _ring(x + radius, y, radius, half, rng)[:-1]
+    # cross over between the two halves so the ring intersects itself
+    ring = left[: half // 2] + right + left[half // 2 :]
+    ring.append(ring[0])
+    return ring
+
+
+def make_feature_collection(features, vertices, variant="valid", seed=0):
+    """Returns a synthetic GeoJSON FeatureCollection of polygons in EPSG:4326.
+
+    :param features: int, number of features
+    :param vertices: int, number of vertices per polygon ring
+    :param variant: string, one of VARIANTS
+    :param seed: int, random seed, fixtures are reproducible for a seed
+    :returns: dict
+    """
+    rng = random.Random(seed)
+    radius = 0.01
+    collection = {"type": "FeatureCollection", "features": []}
+    for i in range(features):
+        x = rng.uniform(EXTENT[0], EXTENT[2])
+        y = rng.uniform(EXTENT[1], EXTENT[3])
+        if variant == "invalid" and i % 2 == 0:
+            geometry = {
+                "type": "Polygon",
+                "coordinates": [_bowtie(x, y, radius, vertices, rng)],
+            }
+        elif variant == "multipart":
+            geometry = {
+                "type": "MultiPolygon",
+                "coordinates": [
+                    [_ring(x + dx, y, radius, vertices, rng)]
+                    for dx in (0, radius * 3, radius * 6)
+                ],
+            }
+        else:
+            geometry = {
+                "type": "Polygon",
+                "coordinates": [_ring(x, y, radius, vertices, rng)],
+            }
+        collection["features"].append(
+            {
+                "type": "Feature",
+                "geometry": geometry,
+                "properties": {"id": str(i), "group": i % MERGE_GROUPS},
+            }
+        )
+    return collection
+
+
+def write_shapefile_zip(collection, directory):
+    """Write a FeatureCollection to a zipped shapefile.
+
+    :param collection: dict returned by make_feature_collection
+    :param directory: string, directory to write to
+    :returns: string, path of the zip file
+    """
+    shp_dir = os.path.join(directory, "shp")
+    os.makedirs(shp_dir)
+    geometry_type = collection["features"][0]["geometry"]["type"]
+    schema = {"geometry": geometry_type, "properties": {"id": "str", "group": "int"}}
+    with fiona.open(
+        os.path.join(shp_dir, "fixture.shp"),
+        "w",
+        driver="ESRI Shapefile",
+        crs=from_epsg(4326),
+        schema=schema,
+    ) as sink:
+        for feature in collection["features"]:
+            sink.write(feature)
+
+    zip_path = os.path.join(directory, "fixture.zip")
+    with zipfile.ZipFile(zip_path, "w") as z:
+        for name in os.listdir(shp_dir):
+            z.write(os.path.join(shp_dir, name), name)
+    return zip_path
+
+
+def write_geojson(collection, directory):
+    path = os.path.join(directory, "fixture.geojson")
+    with open(path, "w") as f:
+        json.dump(collection, f)
+    return path
+
+
+def _read_adapter(adapter, path, merge_on=None, columnar=False):
+    def run():
+        with open(path, "rb") as fp:
+            adapter.read(
+                fp,
+                {"id": "id", "group": "group"},
+                merge_on=merge_on,
+                columnar=columnar,
+            )
+
+    return run
+
+
+# each benchmark builds a zero argument function from a fixture, the build is
+# not timed. fixture is a dict with a fresh copy of the collection for every
+# run, and the paths of the fixture files
+BENCHMARKS = {
+    "get_union": lambda f: lambda: geoutils.get_union(f["collection"]),
+    "get_demo_point": lambda f: lambda: geoutils.get_demo_point(f["collection"]),
+    "get_label_points": lambda f: lambda: geoutils.get_label_points(f["collection"]),
+    "get_area_acres": lambda f: lambda: [
+        geoutils.get_area_acres(feature["geometry"])
+        for feature in f["collection"]["features"]
+    ],
+    "get_areas_acres": lambda f: lambda: geoutils.get_areas_acres(
+        [feature["geometry"] for feature in f["collection"]["features"]]
+    ),
+    "get_bbox_from_geojson": lambda f: lambda: geoutils.get_bbox_from_geojson(
+        f["collection"]
+    ),
+    "merge_features": lambda f: lambda: merge.merge_features(f["collection"], "group"),
+    "merge_features_adjacent": lambda f: lambda: merge.merge_features(
+        f["collection"], "group", adjacent_only=True
+    ),
+    "read_fiona_shp": lambda f: _read_adapter(adapters.shp, f["shp"]),
+    "read_fiona_geojson": lambda f: _read_adapter(adapters.geojson, f["geojson"]),
+    "read_fiona_merge": lambda f: _read_adapter(
+        adapters.shp, f["shp"], merge_on="group"
+    ),
+    "read_fiona_columnar": lambda f: _read_adapter(
+        adapters.shp, f["shp"], columnar=True
+    ),
+}
+
+
+def count_vertices(collection):
+    count = 0
+    for feature in collection["features"]:
+        geometry = feature["geometry"]
+        if geometry["type"] == "Polygon":
+            polygons = [geometry["coordinates"]]
+        else:
+            polygons = geometry["coordinates"]
+        count += sum(len(ring) for polygon in polygons for ring in polygon)
+    return count
+
+
+def run_benchmark(build, fixture, repeat):
+    """Time a benchmark, returning the best wall time of `repeat` runs and the
+    peak memory allocated by Python during a separate traced run. The memory
+    used by GEOS and GDAL is not traced.
+
+    :param build: function building the function to time from a fixture
+    :param fixture: dict
+    :param repeat: int
+    :returns: dict
+    """
+    collection = fixture["collection"]
+
+    def prepare():
+        # functions may mutate the fixture, give each run its own copy
+        return build(dict(fixture, collection=copy.deepcopy(collection)))
+
+    times = []
+    for _ in range(repeat):
+        func = prepare()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    func = prepare()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"seconds": min(times), "times": times, "peak_memory": peak}
+
+
+def get_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Log the speedup of results over a baseline run.
+
+    :param results: list of result dicts
+    :param baseline: dict loaded from a previous --output file
+    """
+    previous = {
+        (r["benchmark"], r["scale"], r["variant"]): r for r in baseline["results"]
+    }
+    lines = [
+        "{:<24} {:<8} {:<10} {:>10} {:>10} {:>8}".format(
+            "benchmark", "scale", "variant", "before", "after", "speedup"
+        )
+    ]
+    for result in results:
+        before = previous.get((result["benchmark"], result["scale"], result["variant"]))
+        if before is None or "seconds" not in before or "seconds" not in result:
+            continue
+        lines.append(
+            "{:<24} {:<8} {:<10} {:>10.4f} {:>10.4f} {:>7.2f}x".format(
+                result["benchmark"],
+                result["scale"],
+                result["variant"],
+                before["seconds"],
+                result["seconds"],
+                before["seconds"] / max(result["seconds"], 1e-9),
+            )
+        )
+    logging.info("Compared to %s:\n%s" % (baseline.get("commit"), "\n".join(lines)))
+
+
+@click.command()
+@click.option(
+    "--scale",
+    "-s",
+    "scales",
+    multiple=True,
+    type=click.Choice(sorted(SCALES)),
+    help="Fixture scale to run, can be repeated. Defaults to small and medium",
+)
+@click.option(
+    "--variant",
+    "-v",
+    "variants",
+    multiple=True,
+    type=click.Choice(VARIANTS),
+    help="Fixture geometry variant to run, can be repeated. Defaults to all",
+)
+@click.option(
+    "--benchmark",
+    "-b",
+    "benchmarks",
+    multiple=True,
+    type=click.Choice(sorted(BENCHMARKS)),
+    help="Benchmark to run, can be repeated. Defaults to all",
+)
+@click.option("--repeat", default=3, help="Number of timed runs per benchmark")
+@click.option("--seed", default=0, help="Random seed for the fixtures")
+@click.option("--output", "-o", type=click.Path(), help="Write results as JSON")
+@click.option(
+    "--compare",
+    "baseline",
+    type=click.File("r"),
+    help="JSON results of a previous run to compare against",
+)
+def benchmark(scales, variants, benchmarks, repeat, seed, output, baseline):
+    """Benchmark the geometry hot paths against synthetic fixtures.
+
+    \b
+    Fixtures are generated locally from a fixed seed, so results of runs on
+    different commits can be compared with --output and --compare.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] - %(message)s",
+        datefmt="%H:%M:%S",
+    )
+    logging.getLogger("processing").setLevel(logging.WARNING)
+
+    scales = scales or ["small", "medium"]
+    variants = variants or VARIANTS
+    benchmarks = benchmarks or sorted(BENCHMARKS)
+
+    results = []
+    for scale in scales:
+        for variant in variants:
+            collection = make_feature_collection(
+                SCALES[scale]["features"], SCALES[scale]["vertices"], variant, seed
+            )
+            directory = tempfile.mkdtemp()
+            try:
+                fixture = {
+                    "collection": collection,
+                    "shp": write_shapefile_zip(collection, directory),
+                    "geojson": write_geojson(collection, directory),
+                }
+                features = len(collection["features"])
+                vertices = count_vertices(collection)
+                for name in benchmarks:
+                    logging.info("Running %s on %s %s" % (name, scale, variant))
+                    result = {
+                        "benchmark": name,
+                        "scale": scale,
+                        "variant": variant,
+                        "features": features,
+                        "vertices": vertices,
+                    }
+                    try:
+                        result.update(run_benchmark(BENCHMARKS[name], fixture, repeat))
+                        result["features_per_second"] = features / result["seconds"]
+                        result["vertices_per_second"] = vertices / result["seconds"]
+                    except Exception as e:
+                        logging.exception("Benchmark %s failed" % name)
+                        result["error"] = str(e)
+                    results.append(result)
+            finally:
+                shutil.rmtree(directory)
+
+    lines = [
+        "{:<24} {:<8} {:<10} {:>10} {:>12} {:>12}".format(
+            "benchmark", "scale", "variant", "seconds", "features/s", "peak MB"
+        )
+    ]
+    for result in results:
+        if "error" in result:
+            lines.append(
+                "{:<24} {:<8} {:<10} failed".format(
+                    result["benchmark"], result["scale"], result["variant"]
+                )
+            )
+            continue
+        lines.append(
+            "{:<24} {:<8} {:<10} {:>10.4f} {:>12.0f} {:>12.1f}".format(
+                result["benchmark"],
+                result["scale"],
+                result["variant"],
+                result["seconds"],
+                result["features_per_second"],
+                result["peak_memory"] / 1024.0 / 1024.0,
+            )
+        )
+    logging.info("Results:\n" + "\n".join(lines))
+
+    run = {
+        "commit": get_commit(),
+        "python": sys.version,
+        "platform": platform.platform(),
+        "seed": seed,
+        "repeat": repeat,
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(run, f, indent=2)
+
+    if baseline:
+        compare(results, json.load(baseline))
+
+
+if __name__ == "__main__":
+    benchmark()
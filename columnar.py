@@ -0,0 +1,495 @@
+from array import array
+
+import numpy as np
+from shapely.geometry import MultiPolygon
+from shapely.geometry import Polygon
+from shapely.geometry import shape
+
+POLYGONAL_TYPES = ("Polygon", "MultiPolygon")
+
+# fills the property columns of features that do not have the property
+_MISSING = object()
+
+
+class FeatureStoreBuilder(object):
+    """Packs GeoJSON features into a FeatureStore one at a time, so the
+    features of a source are never all held as dicts.
+    """
+
+    def __init__(self):
+        super(FeatureStoreBuilder, self).__init__()
+        self.count = 0
+        # interleaved x and y of every position
+        self.coords = array("d")
+        # positions are grouped in rings, rings in parts and parts in
+        # geometries, each level holds the offsets of its groups in the next
+        self.ring_offsets = array("q", [0])
+        self.part_offsets = array("q", [0])
+        self.geometry_offsets = array("q", [0])
+        self.geometry_types = []
+        # geometries of other types, eg. GeometryCollections, kept as they are
+        self.other_geometries = {}
+        self.valid = []
+        # the keys of each feature and of its properties, as indexes in
+        # lists of distinct key tuples, to keep their order
+        self.layouts = []
+        self.layout_indexes = {}
+        self.feature_layouts = array("l")
+        self.property_layouts = []
+        self.property_layout_indexes = {}
+        self.feature_property_layouts = array("l")
+        # top level members other than geometry and properties, eg. type and id
+        self.members = {}
+        self.properties = {}
+
+    def append(self, feature, is_valid=None):
+        """Add a feature to the store.
+
+        :param feature: GeoJSON feature dict
+        :param is_valid: bool, whether the geometry is valid, None if not known
+        """
+        geometry = feature["geometry"]
+        geometry_type = geometry["type"]
+        coordinates = geometry["coordinates"] if "coordinates" in geometry else None
+        if geometry_type == "Point":
+            parts = [[[coordinates]]]
+        elif geometry_type in ("MultiPoint", "LineString"):
+            parts = [[coordinates]]
+        elif geometry_type in ("MultiLineString", "Polygon"):
+            parts = [coordinates]
+        elif geometry_type == "MultiPolygon":
+            parts = coordinates
+        else:
+            self.other_geometries[self.count] = geometry
+            parts = []
+
+        coords = self.coords
+        for part in parts:
+            for ring in part:
+                coords.extend([v for c in ring for v in (c[0], c[1])])
+                self.ring_offsets.append(len(coords) // 2)
+            self.part_offsets.append(len(self.ring_offsets) - 1)
+        self.geometry_offsets.append(len(self.part_offsets) - 1)
+        self.geometry_types.append(geometry_type)
+        self.valid.append(is_valid)
+
+        keys = tuple(feature)
+        self.feature_layouts.append(
+            _get_layout_index(keys, self.layouts, self.layout_indexes)
+        )
+        for key in keys:
+            if key not in ("geometry", "properties"):
+                _append_value(self.members, key, feature[key], self.count)
+
+        properties = feature.get("properties") or {}
+        keys = tuple(properties)
+        self.feature_property_layouts.append(
+            _get_layout_index(keys, self.property_layouts, self.property_layout_indexes)
+        )
+        for key in keys:
+            _append_value(self.properties, key, properties[key], self.count)
+
+        self.count += 1
+
+    def build(self):
+        """Returns the FeatureStore of the features added so far.
+
+        :returns: FeatureStore
+        """
+        count = self.count
+        for columns in (self.members, self.properties):
+            for column in columns.values():
+                column.extend([_MISSING] * (count - len(column)))
+
+        return FeatureStore(
+            coords=np.frombuffer(self.coords, dtype=float).reshape(-1, 2),
+            ring_offsets=np.frombuffer(self.ring_offsets, dtype=np.int64),
+            part_offsets=np.frombuffer(self.part_offsets, dtype=np.int64),
+            geometry_offsets=np.frombuffer(self.geometry_offsets, dtype=np.int64),
+            geometry_types=self.geometry_types,
+            other_geometries=self.other_geometries,
+            valid=self.valid,
+            layouts=self.layouts,
+            feature_layouts=self.feature_layouts,
+            property_layouts=self.property_layouts,
+            feature_property_layouts=self.feature_property_layouts,
+            members=self.members,
+            properties={k: _get_typed_column(v) for k, v in self.properties.items()},
+        )
+
+
+def _get_layout_index(keys, layouts, indexes):
+    index = indexes.get(keys)
+    if index is None:
+        index = len(layouts)
+        layouts.append(keys)
+        indexes[keys] = index
+    return index
+
+
+def _append_value(columns, key, value, index):
+    column = columns.get(key)
+    if column is None:
+        column = columns[key] = []
+    if len(column) < index:
+        column.extend([_MISSING] * (index - len(column)))
+    column.append(value)
+
+
+def _get_typed_column(values):
+    """Returns the values of a property as a numpy array if they are all ints
+    or all floats, and as the list of values otherwise."""
+    types = set(type(v) for v in values)
+    if types == {float}:
+        return np.array(values, dtype=float)
+    if types == {int}:
+        try:
+            return np.array(values, dtype=np.int64)
+        except OverflowError:
+            pass
+    return values
+
+
+class FeatureStore(object):
+    """Features of a source held in columns instead of GeoJSON dicts.
+
+    The positions of all geometries are a single array, grouped into rings,
+    parts and geometries by offset arrays. Properties whose values are all
+    ints or all floats are numpy arrays. Indexing or iterating the store
+    returns GeoJSON dicts of its features, built on demand, so the store can
+    be used as the features of a FeatureCollection. Functions in geoutils work
+    on the columns directly.
+    """
+
+    def __init__(
+        self,
+        coords,
+        ring_offsets,
+        part_offsets,
+        geometry_offsets,
+        geometry_types,
+        other_geometries,
+        valid,
+        layouts,
+        feature_layouts,
+        property_layouts,
+        feature_property_layouts,
+        members,
+        properties,
+    ):
+        super(FeatureStore, self).__init__()
+        self.coords = coords
+        self.ring_offsets = ring_offsets
+        self.part_offsets = part_offsets
+        self.geometry_offsets = geometry_offsets
+        self.geometry_types = geometry_types
+        self.other_geometries = other_geometries
+        self.valid = valid
+        self.layouts = layouts
+        self.feature_layouts = feature_layouts
+        self.property_layouts = property_layouts
+        self.feature_property_layouts = feature_property_layouts
+        self.members = members
+        self.properties = properties
+        self.bboxes = None
+
+    def __len__(self):
+        return len(self.geometry_types)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.get_feature(i)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("feature index out of range")
+        return self.get_feature(i)
+
+    def get_feature(self, i):
+        """Returns a feature as a GeoJSON dict.
+
+        :param i: int
+        :returns: dict
+        """
+        feature = {}
+        for key in self.layouts[self.feature_layouts[i]]:
+            if key == "geometry":
+                feature[key] = self.get_geometry(i)
+            elif key == "properties":
+                feature[key] = self.get_properties(i)
+            elif key == "bbox" and self.bboxes is not None:
+                feature[key] = tuple(self.bboxes[i].tolist())
+            else:
+                feature[key] = self.members[key][i]
+        return feature
+
+    def get_properties(self, i):
+        """Returns the properties of a feature as a dict.
+
+        :param i: int
+        :returns: dict
+        """
+        properties = {}
+        for key in self.property_layouts[self.feature_property_layouts[i]]:
+            value = self.properties[key][i]
+            if isinstance(value, np.generic):
+                value = value.item()
+            properties[key] = value
+        return properties
+
+    def get_property(self, key):
+        """Returns a property of all features, with None for features that do
+        not have it.
+
+        :param key: string
+        :returns: list
+        """
+        column = self.properties.get(key)
+        if column is None:
+            return [None] * len(self)
+        if isinstance(column, np.ndarray):
+            return column.tolist()
+        return [None if v is _MISSING else v for v in column]
+
+    def get_features_with_property(self, key):
+        """Returns the indexes of the features that have a property.
+
+        :param key: string
+        :returns: list of ints
+        """
+        layouts = [key in keys for keys in self.property_layouts]
+        return [
+            i
+            for i, layout in enumerate(self.feature_property_layouts)
+            if layouts[layout]
+        ]
+
+    def set_property(self, key, values):
+        """Set a property of all features, adding it after their other
+        properties if they do not have it.
+
+        :param key: string
+        :param values: list with a value per feature
+        """
+        self.properties[key] = _get_typed_column(list(values))
+        _add_key(
+            self.property_layouts, self.feature_property_layouts, key, range(len(self))
+        )
+
+    def set_member(self, key, values, features=None):
+        """Set a top level member of features, eg. id, adding it after their
+        other members if they do not have it.
+
+        :param key: string
+        :param values: list with a value per feature
+        :param features: list of the indexes of the features values are for,
+            defaults to all features
+        """
+        if features is None:
+            features = range(len(self))
+        column = self.members.get(key)
+        if column is None:
+            column = self.members[key] = [_MISSING] * len(self)
+        for i, value in zip(features, values):
+            column[i] = value
+        _add_key(self.layouts, self.feature_layouts, key, features)
+
+    def set_bboxes(self, bboxes):
+        """Set the bbox member of all features.
+
+        :param bboxes: numpy array with a (minx, miny, maxx, maxy) row per
+            feature
+        """
+        self.bboxes = bboxes
+        _add_key(self.layouts, self.feature_layouts, "bbox", range(len(self)))
+
+    def get_ring_slice(self, ring):
+        return slice(self.ring_offsets[ring], self.ring_offsets[ring + 1])
+
+    def get_ring_lengths(self, rings):
+        """Returns the number of positions of rings.
+
+        :param rings: numpy array of ring indexes
+        :returns: numpy array
+        """
+        return self.ring_offsets[rings + 1] - self.ring_offsets[rings]
+
+    def get_rings_coords(self, rings):
+        """Returns the positions of rings, one after the other.
+
+        :param rings: numpy array of ring indexes
+        :returns: numpy array with an (x, y) row per position
+        """
+        starts = self.ring_offsets[rings]
+        return self.coords[_get_ranges(starts, self.ring_offsets[rings + 1] - starts)]
+
+    def get_geometry(self, i):
+        """Returns the geometry of a feature as a GeoJSON dict.
+
+        :param i: int
+        :returns: dict
+        """
+        geometry_type = self.geometry_types[i]
+        if i in self.other_geometries:
+            return self.other_geometries[i]
+
+        parts = []
+        for part in range(self.geometry_offsets[i], self.geometry_offsets[i + 1]):
+            parts.append(
+                [
+                    self.coords[self.get_ring_slice(ring)].tolist()
+                    for ring in range(
+                        self.part_offsets[part], self.part_offsets[part + 1]
+                    )
+                ]
+            )
+        if geometry_type == "Point":
+            coordinates = parts[0][0][0]
+        elif geometry_type in ("MultiPoint", "LineString"):
+            coordinates = parts[0][0]
+        elif geometry_type in ("MultiLineString", "Polygon"):
+            coordinates = parts[0]
+        else:
+            coordinates = parts
+        return {"type": geometry_type, "coordinates": coordinates}
+
+    def get_shape(self, i):
+        """Returns the geometry of a feature as a shapely geometry, built from
+        the position array without going through GeoJSON for polygons.
+
+        :param i: int
+        :returns: shapely geometry
+        """
+        geometry_type = self.geometry_types[i]
+        if geometry_type not in POLYGONAL_TYPES:
+            return shape(self.get_geometry(i))
+
+        polygons = []
+        for part in range(self.geometry_offsets[i], self.geometry_offsets[i + 1]):
+            rings = [
+                self.coords[self.get_ring_slice(ring)]
+                for ring in range(self.part_offsets[part], self.part_offsets[part + 1])
+            ]
+            polygons.append((rings[0], rings[1:]) if rings else None)
+        if geometry_type == "Polygon":
+            return Polygon(*polygons[0]) if polygons[0] else Polygon()
+        # parts are built as MultiPolygon does from (shell, holes) tuples,
+        # without Polygons of their own
+        return MultiPolygon([p for p in polygons if p is not None])
+
+    def is_valid(self, i, geometry=None):
+        """Returns whether the geometry of a feature is valid.
+
+        :param i: int
+        :param geometry: the shapely geometry of the feature, if already built
+        :returns: bool
+        """
+        if self.valid[i] is None:
+            if geometry is None:
+                geometry = self.get_shape(i)
+            self.valid[i] = geometry.is_valid
+        return self.valid[i]
+
+    def get_polygonal_features(self):
+        """Returns the indexes of the features with Polygon or MultiPolygon
+        geometries.
+
+        :returns: list of ints
+        """
+        return [
+            i
+            for i, geometry_type in enumerate(self.geometry_types)
+            if geometry_type in POLYGONAL_TYPES
+        ]
+
+    def get_rings(self, features):
+        """Returns the rings of features and the feature of each.
+
+        :param features: list of feature indexes
+        :returns: numpy arrays of ring indexes and of their feature indexes
+        """
+        features = np.asarray(features, dtype=np.int64)
+        part_starts = self.geometry_offsets[features]
+        part_counts = self.geometry_offsets[features + 1] - part_starts
+        parts = _get_ranges(part_starts, part_counts)
+        ring_starts = self.part_offsets[parts]
+        ring_counts = self.part_offsets[parts + 1] - ring_starts
+        rings = _get_ranges(ring_starts, ring_counts)
+        owners = np.repeat(np.repeat(features, part_counts), ring_counts)
+        return rings, owners
+
+    def get_exterior_rings(self, rings):
+        """Returns whether rings are the exterior ring of their polygon.
+
+        :param rings: numpy array of ring indexes
+        :returns: numpy boolean array
+        """
+        is_exterior = np.zeros(len(self.ring_offsets) - 1, dtype=bool)
+        is_exterior[self.part_offsets[:-1][np.diff(self.part_offsets) > 0]] = True
+        return is_exterior[rings]
+
+    def get_rings_bounds(self, rings):
+        """Returns the bounding boxes of non empty rings.
+
+        :param rings: numpy array of ring indexes
+        :returns: numpy array with a (minx, miny, maxx, maxy) row per ring
+        """
+        return _get_bounds(
+            self.coords, self.ring_offsets[rings], self.ring_offsets[rings + 1]
+        )
+
+    def get_bboxes(self):
+        """Returns the bounding boxes of all features, features without
+        positions get NaNs.
+
+        :returns: numpy array with a (minx, miny, maxx, maxy) row per feature
+        """
+        starts = self.ring_offsets[self.part_offsets[self.geometry_offsets[:-1]]]
+        ends = self.ring_offsets[self.part_offsets[self.geometry_offsets[1:]]]
+        bboxes = np.full((len(self), 4), np.nan)
+        present = ends > starts
+        bboxes[present] = _get_bounds(self.coords, starts[present], ends[present])
+        return bboxes
+
+
+def _add_key(layouts, feature_layouts, key, features):
+    """Add a key after the other keys of the layouts of features."""
+    added = {}
+    for i in features:
+        layout = feature_layouts[i]
+        if key in layouts[layout]:
+            continue
+        if layout not in added:
+            keys = layouts[layout] + (key,)
+            if keys not in layouts:
+                layouts.append(keys)
+            added[layout] = layouts.index(keys)
+        feature_layouts[i] = added[layout]
+
+
+def _get_ranges(starts, counts):
+    """Returns the concatenation of ranges of integers."""
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+    return np.arange(total, dtype=np.int64) + offsets
+
+
+def _get_bounds(coords, starts, ends):
+    """Returns the bounding boxes of non empty ranges of positions."""
+    if len(starts) == 0:
+        return np.zeros((0, 4))
+    # reduceat reduces from each index up to the next, so interleaving starts
+    # and ends reduces each range on its own, the reductions from an end to
+    # the next start are dropped. The padding row lets an end be the last
+    # position
+    indexes = np.empty(2 * len(starts), dtype=np.int64)
+    indexes[0::2] = starts
+    indexes[1::2] = ends
+    padded = np.vstack((coords, coords[-1:]))
+    mins = np.minimum.reduceat(padded, indexes, axis=0)[0::2]
+    maxs = np.maximum.reduceat(padded, indexes, axis=0)[0::2]
+    return np.hstack((mins, maxs))
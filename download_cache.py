@@ -0,0 +1,363 @@
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+
+import boto3
+import ujson
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+INDEX_FILENAME = ".index.sqlite"
+TMP_DIRNAME = ".tmp"
+# seconds after which staging files left in the temporary directory are
+# removed
+TMP_MAX_AGE = 24 * 60 * 60
+# prefix of the files staged in the temporary directory before they are
+# renamed into place, the only files removed once abandoned
+STAGING_PREFIX = "staging-"
+# prefix of the files downloaded into the temporary directory, which their
+# consumers remove
+DOWNLOAD_PREFIX = "download-"
+# seconds to wait for another process to release the index
+LOCK_TIMEOUT = 60
+
+# S3 object metadata holding the validators of the cached download
+VALIDATOR_METADATA = {
+    "ETag": "upstream-etag",
+    "Last-Modified": "upstream-last-modified",
+}
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=10,
+)
+
+_s3_clients = {}
+# temporary directories this process removed stale staging files from, so
+# they are swept once per process and not for every download
+_swept_tmp_paths = set()
+
+
+def get_download_cache():
+    """Returns the download cache configured by the DOWNLOAD_CACHE and
+    DOWNLOAD_CACHE_MAX_BYTES environment variables, or None if DOWNLOAD_CACHE
+    is not set.
+
+    :returns: DownloadCache
+    """
+    path = os.getenv("DOWNLOAD_CACHE")
+    if path is None:
+        return None
+    max_bytes = os.getenv("DOWNLOAD_CACHE_MAX_BYTES")
+    return DownloadCache(path, int(max_bytes) if max_bytes else None)
+
+
+class DownloadCache(object):
+    """Local cache of downloaded files, keyed by url.
+
+    Entries are files in the cache directory named by the sha224 of their url.
+    An sqlite index records the size, last access time and HTTP validators of
+    each entry, and the least recently used entries are evicted when the cache
+    grows over `max_bytes`. Entries are read only and are handed out as hard
+    links, so a hit does not copy the file.
+
+    The index serializes inserts and evictions between processes sharing the
+    cache. Files are staged in a temporary directory inside the cache and
+    renamed into place, so an entry is never seen partially written. Staging
+    files abandoned there for more than TMP_MAX_AGE are removed the first
+    time a process opens the cache, other files there belong to consumers.
+    """
+
+    def __init__(self, path, max_bytes=None):
+        """
+        :param path: string, cache directory
+        :param max_bytes: int, maximum total size of the entries, or None for
+            no limit
+        """
+        super(DownloadCache, self).__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(path, INDEX_FILENAME)
+        self.tmp_path = os.path.join(path, TMP_DIRNAME)
+        os.makedirs(self.tmp_path, exist_ok=True)
+
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, url TEXT, size INTEGER, "
+                "last_access REAL, validators TEXT)"
+            )
+        if (os.getpid(), self.tmp_path) not in _swept_tmp_paths:
+            _swept_tmp_paths.add((os.getpid(), self.tmp_path))
+            self._remove_stale_tmp_files()
+
+    @contextmanager
+    def _transaction(self):
+        db = sqlite3.connect(
+            self.index_path, timeout=LOCK_TIMEOUT, isolation_level=None
+        )
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    def _remove_stale_tmp_files(self):
+        now = time.time()
+        for name in os.listdir(self.tmp_path):
+            if not name.startswith(STAGING_PREFIX):
+                continue
+            path = os.path.join(self.tmp_path, name)
+            try:
+                if now - os.path.getmtime(path) > TMP_MAX_AGE:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def get_key(self, url):
+        return hashlib.sha224(url.encode()).hexdigest()
+
+    def get_entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def create_download_file(self, suffix=""):
+        """Returns a new temporary file in the cache directory, for a consumer
+        to download into and remove. Being in the cache directory, it can be
+        added to the cache and replaced with an entry without copying.
+
+        :param suffix: string, file name suffix
+        :returns: file object opened for writing
+        """
+        return tempfile.NamedTemporaryFile(
+            "wb", prefix=DOWNLOAD_PREFIX, suffix=suffix, delete=False, dir=self.tmp_path
+        )
+
+    def get(self, url):
+        """Returns the cache entry for a url and marks it as used, or None if
+        the url is not cached.
+
+        :param url: string
+        :returns: dict with the path and validators of the entry
+        """
+        key = self.get_key(url)
+        entry_path = self.get_entry_path(key)
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT validators FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if not os.path.isfile(entry_path):
+                if row is not None:
+                    db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+
+            if row is None:
+                # an entry written before the cache was indexed
+                validators = {}
+                db.execute(
+                    "INSERT INTO entries VALUES (?, ?, ?, ?, ?)",
+                    (key, url, os.path.getsize(entry_path), time.time(), "{}"),
+                )
+            else:
+                validators = ujson.loads(row[0])
+                db.execute(
+                    "UPDATE entries SET last_access = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+        return {"path": entry_path, "validators": validators}
+
+    def checkout(self, entry, path):
+        """Replace a file with a cache entry, for a consumer to read and
+        remove. The file becomes a hard link to the entry where possible, and
+        a copy otherwise.
+
+        :param entry: dict returned by get
+        :param path: string, a file returned by create_download_file
+        :returns: bool, False if the entry was evicted since it was looked up,
+            the file is left untouched then
+        """
+        staged = self._get_staging_path()
+        try:
+            os.link(entry["path"], staged)
+            # a link shares the mtime of the entry, renew it so the file is
+            # not taken for an abandoned one
+            os.utime(staged)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            shutil.copy(entry["path"], staged)
+        os.replace(staged, path)
+        return True
+
+    def _get_staging_path(self):
+        fd, staged = tempfile.mkstemp(prefix=STAGING_PREFIX, dir=self.tmp_path)
+        os.close(fd)
+        os.remove(staged)
+        return staged
+
+    def put(self, url, filename, validators=None):
+        """Add a copy of a file to the cache, evicting the least recently used
+        entries if the cache grows over its budget. The file itself is left in
+        place and writable, only the copy is made read only.
+
+        :param url: string
+        :param filename: string, file downloaded from url
+        :param validators: dict of HTTP validators of the download
+        """
+        key = self.get_key(url)
+        size = os.path.getsize(filename)
+        if self.max_bytes is not None and size > self.max_bytes:
+            logging.info("Not caching %s, it is larger than the cache" % url)
+            return
+
+        staged = self._get_staging_path()
+        shutil.copyfile(filename, staged)
+        os.chmod(staged, 0o444)
+
+        with self._transaction() as db:
+            os.replace(staged, self.get_entry_path(key))
+            db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, url, size, time.time(), ujson.dumps(validators or {})),
+            )
+            self._evict(db, key)
+
+    def _evict(self, db, keep):
+        if self.max_bytes is None:
+            return
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        rows = db.execute(
+            "SELECT key, url, size FROM entries WHERE key != ? ORDER BY last_access",
+            (keep,),
+        ).fetchall()
+        for key, url, size in rows:
+            if total <= self.max_bytes:
+                break
+            logging.info("Evicting %s from local cache" % url)
+            try:
+                os.remove(self.get_entry_path(key))
+            except FileNotFoundError:
+                pass
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+
+
+def get_s3_client(endpoint_url=None):
+    """Returns the S3 client of this process for an endpoint. Clients are
+    thread safe and are shared by the transfers of a process.
+
+    :param endpoint_url: string, or None for AWS
+    :returns: boto3 S3 client
+    """
+    key = (os.getpid(), endpoint_url)
+    client = _s3_clients.get(key)
+    if client is None:
+        # sessions are not thread safe, each client gets its own
+        client = boto3.session.Session().client("s3", endpoint_url=endpoint_url)
+        _s3_clients[key] = client
+    return client
+
+
+def get_s3_cache():
+    """Returns the S3 download cache configured by the S3_CACHE_BUCKET,
+    S3_CACHE_PREFIX and S3_CACHE_ENDPOINT_URL environment variables, or None
+    if S3_CACHE_BUCKET is not set.
+
+    :returns: S3Cache
+    """
+    bucket = os.getenv("S3_CACHE_BUCKET")
+    if bucket is None:
+        return None
+    return S3Cache(
+        bucket,
+        prefix=os.getenv("S3_CACHE_PREFIX", ""),
+        endpoint_url=os.getenv("S3_CACHE_ENDPOINT_URL"),
+    )
+
+
+class S3Cache(object):
+    """Cache of downloaded files in an S3 bucket, keyed by url.
+
+    The HTTP validators of a download are stored as metadata of its object,
+    so a cached copy can be checked against the upstream server. Transfers
+    use multipart uploads and downloads with concurrent parts for large files.
+    """
+
+    def __init__(self, bucket, prefix="", endpoint_url=None):
+        """
+        :param bucket: string
+        :param prefix: string, prefix of the cache keys
+        :param endpoint_url: string, S3 endpoint, None for AWS
+        """
+        super(S3Cache, self).__init__()
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = get_s3_client(endpoint_url)
+
+    def get_key(self, url):
+        return self.prefix + hashlib.sha224(url.encode()).hexdigest()
+
+    def get_uri(self, url):
+        return "s3://%s/%s" % (self.bucket, self.get_key(url))
+
+    def head(self, url):
+        """Returns the size and the upstream validators of the cached copy of
+        a url, or None if it is not cached. Errors other than a missing
+        object are raised.
+
+        :param url: string
+        :returns: dict
+        """
+        try:
+            res = self.client.head_object(Bucket=self.bucket, Key=self.get_key(url))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        metadata = res.get("Metadata", {})
+        return {
+            "size": res["ContentLength"],
+            "validators": {
+                h: metadata[m] for h, m in VALIDATOR_METADATA.items() if m in metadata
+            },
+        }
+
+    def download(self, url, fp):
+        """Download the cached copy of a url to a file object.
+
+        :param url: string
+        :param fp: file-like object opened for writing
+        """
+        self.client.download_fileobj(
+            self.bucket, self.get_key(url), fp, Config=S3_TRANSFER_CONFIG
+        )
+
+    def upload(self, url, filename, validators=None):
+        """Store a file downloaded from a url in the cache.
+
+        :param url: string
+        :param filename: string
+        :param validators: dict of HTTP validators of the download
+        """
+        metadata = {
+            VALIDATOR_METADATA[h]: v for h, v in list((validators or {}).items())
+        }
+        self.client.upload_file(
+            filename,
+            self.bucket,
+            self.get_key(url),
+            ExtraArgs={"Metadata": metadata},
+            Config=S3_TRANSFER_CONFIG,
+        )
@@ -1,12 +1,29 @@
+import math
 import re
 
+from fiona.transform import transform_geom
+from shapely.geometry import box
+from shapely.geometry import mapping
+from shapely.geometry import MultiPolygon
+from shapely.geometry import Polygon
+from shapely.geometry import shape
+from shapely.prepared import prep
+
+# longest edge, in degrees, of a spatial filter reprojected to the CRS of a
+# source, longer edges are split so they follow the curve they project to
+SPATIAL_FILTER_SEGMENT = 0.01
+
 
 class FilteringFailedException(Exception):
     pass
 
 
 class BasicFilterer(object):
-    """Filter that reads in a dictionary and filters based on feature properties"""
+    """Filter that reads in a dictionary and filters based on feature properties
+
+    Each item of the definition is compiled once into a test of the properties
+    of a feature, with its key bound and its regular expression compiled.
+    """
 
     def __init__(self, filter_def, filter_operator):
         super(BasicFilterer, self).__init__()
@@ -16,47 +33,156 @@ class BasicFilterer(object):
             raise FilteringFailedException(
                 "Unknown filter operator:%s" % filter_operator
             )
+        self.tests = [_compile_test(item) for item in filter_def]
 
     def keep(self, feature):
-        for item in self.filter_def:
-            if not "expression" in item:
-                raise FilteringFailedException(
-                    "Expression missing from filter definition" % (key, value)
-                )
-            if item["expression"] == "not null":
-                test_success = (
-                    item["key"] in feature["properties"]
-                    and feature["properties"][item["key"]] is not None
-                )
-            elif item["expression"] == "=":
-                test_success = (
-                    item["key"] in feature["properties"]
-                    and feature["properties"][item["key"]] == item["value"]
-                )
-            elif item["expression"] == "!=":
-                test_success = (
-                    item["key"] not in feature["properties"]
-                    or feature["properties"][item["key"]] != item["value"]
-                )
-            elif item["expression"] == "match" or item["expression"] == "not match":
-                test_success = (
-                    item["key"] in feature["properties"]
-                    and feature["properties"][item["key"]] is not None
-                    and re.match(item["value"], feature["properties"][item["key"]])
-                )
-                if item["expression"] == "not match":
-                    test_success = not test_success
-            else:
+        properties = feature["properties"]
+        if self.operator == "and":
+            for test in self.tests:
+                if not test(properties):
+                    return False
+            return True
+        else:
+            for test in self.tests:
+                if test(properties):
+                    return True
+            return False
+
+
+class SpatialFilter(object):
+    """Filter that keeps the features intersecting an area, and optionally
+    clips them to it.
+
+    The area is the "bbox", a [west, south, east, north] list, or the
+    "geometry", a GeoJSON Polygon or MultiPolygon, of the filter definition,
+    in EPSG:4326. Features are clipped if its "clip" is true.
+    """
+
+    def __init__(self, filter_def):
+        super(SpatialFilter, self).__init__()
+        self.filter_def = filter_def
+        if ("bbox" in filter_def) == ("geometry" in filter_def):
+            raise FilteringFailedException(
+                "Spatial filter needs one of bbox or geometry"
+            )
+        if "bbox" in filter_def:
+            self.shape = box(*filter_def["bbox"])
+        else:
+            self.shape = shape(filter_def["geometry"])
+            if type(self.shape) not in (Polygon, MultiPolygon):
                 raise FilteringFailedException(
-                    "Unhandled filtering expression:%s" % (item["expression"])
+                    "Unhandled spatial filter geometry:%s" % self.shape.geom_type
                 )
+        self.clip = bool(filter_def.get("clip", False))
+        self.prepared = prep(self.shape)
 
-            if self.operator == "and" and not test_success:
-                return False
-            elif self.operator == "or" and test_success:
-                return True
+    def get_source_filter(self, crs):
+        """Returns the filter as arguments of fiona's Collection.filter for a
+        source, reprojected to its CRS. Features they select still have to be
+        tested with filter_shape.
 
-        if self.operator == "or":
-            return False
-        else:
-            return True
+        :param crs: the CRS of the source, as in a fiona collection
+        :returns: dict with the bbox or the mask to read
+        """
+        polygon = mapping(_densify(self.shape, SPATIAL_FILTER_SEGMENT))
+        reprojected = transform_geom("EPSG:4326", crs, polygon)
+        if "bbox" in self.filter_def:
+            return {"bbox": shape(reprojected).bounds}
+        return {"mask": reprojected}
+
+    def filter_shape(self, geometry):
+        """Test a geometry against the filter, clipping it if the filter clips.
+
+        :param geometry: A shapely geometry in EPSG:4326
+        :returns: The geometry, or its clipped part, or None if it is outside
+            the filter
+        """
+        if not self.prepared.intersects(geometry):
+            return None
+        if not self.clip or self.prepared.contains(geometry):
+            return geometry
+
+        clipped = geometry.intersection(self.shape)
+        if type(geometry) in (Polygon, MultiPolygon) and type(clipped) not in (
+            Polygon,
+            MultiPolygon,
+        ):
+            # polygons touching the filter leave lines and points
+            polygons = [
+                g
+                for g in getattr(clipped, "geoms", [])
+                if type(g) == Polygon and not g.is_empty
+            ]
+            if not polygons:
+                return None
+            clipped = polygons[0] if len(polygons) == 1 else MultiPolygon(polygons)
+        if clipped.is_empty:
+            return None
+        return clipped
+
+
+def _densify(geometry, segment):
+    """Returns a Polygon or MultiPolygon with points added along its edges, so
+    no edge is longer than segment."""
+
+    def densify_ring(ring):
+        coords = [c[:2] for c in ring.coords]
+        densified = []
+        for (x0, y0), (x1, y1) in zip(coords[:-1], coords[1:]):
+            count = max(1, int(math.ceil(math.hypot(x1 - x0, y1 - y0) / segment)))
+            densified.extend(
+                (x0 + (x1 - x0) * i / count, y0 + (y1 - y0) * i / count)
+                for i in range(count)
+            )
+        densified.append(coords[-1])
+        return densified
+
+    if type(geometry) == Polygon:
+        polygons = [geometry]
+    else:
+        polygons = list(geometry.geoms)
+    densified = [
+        Polygon(densify_ring(p.exterior), [densify_ring(r) for r in p.interiors])
+        for p in polygons
+    ]
+    return densified[0] if type(geometry) == Polygon else MultiPolygon(densified)
+
+
+def _compile_test(item):
+    """Returns a function testing the properties of a feature against an item
+    of a filter definition."""
+    if not "expression" in item:
+        raise FilteringFailedException("Expression missing from filter definition")
+    expression = item["expression"]
+    key = item["key"]
+
+    if expression == "not null":
+
+        def test(properties):
+            return key in properties and properties[key] is not None
+
+    elif expression == "=":
+        value = item["value"]
+
+        def test(properties):
+            return key in properties and properties[key] == value
+
+    elif expression == "!=":
+        value = item["value"]
+
+        def test(properties):
+            return key not in properties or properties[key] != value
+
+    elif expression == "match" or expression == "not match":
+        match = re.compile(item["value"]).match
+        negate = expression == "not match"
+
+        def test(properties):
+            value = properties.get(key)
+            return (value is not None and match(value) is not None) != negate
+
+    else:
+        raise FilteringFailedException(
+            "Unhandled filtering expression:%s" % (expression)
+        )
+    return test
@@ -1,70 +1,300 @@
 import logging
+import math
+import signal
+import threading
 from functools import partial
+from itertools import chain
+from multiprocessing import Pool
 
 import mercantile
+import numpy as np
 import pyproj
-from rtree import index
 from shapely.geometry import GeometryCollection
 from shapely.geometry import LineString
 from shapely.geometry import mapping
 from shapely.geometry import MultiPolygon
+from shapely.geometry import Point
 from shapely.geometry import Polygon
 from shapely.geometry import shape
 from shapely.ops import cascaded_union
 from shapely.ops import transform
+from shapely.prepared import prep
 
 import utils
+from columnar import FeatureStore
 
 logger = logging.getLogger("processing")
 
+# number of shapes unioned at once, larger collections are unioned in groups
+UNION_GROUP_SIZE = 1000
+# precision of label points, in web mercator meters
+POLYLABEL_TOLERANCE = 1.0
+# seconds polylabel may spend on a polygon, None for no limit. The limit is
+# checked between GEOS operations, in the main thread of a process only
+POLYLABEL_TIMEOUT = None
+# minimum number of features to run polylabel in a pool of processes for
+POLYLABEL_POOL_MIN = 1000
 
-def get_union(geojson):
-    """ Returns a geojson geometry that is the union of all features in a geojson feature collection """
+_projs = {}
+
+
+class Feature(dict):
+    """ A GeoJSON feature that keeps the shapely geometry of its "geometry",
+    with its validity and area, so they are computed once however many
+    functions use them
+
+    Setting "geometry" drops the cached geometry, as does pickling.
+    """
+
+    _shape = None
+    _is_valid = None
+    _area = None
+
+    def __setitem__(self, key, value):
+        if key == "geometry":
+            self._shape = None
+            self._is_valid = None
+            self._area = None
+        super(Feature, self).__setitem__(key, value)
+
+    def __getstate__(self):
+        return None
+
+    def set_shape(self, geometry, is_valid=None):
+        """ Set the geometry of the feature from a shapely geometry
+
+        :param geometry: A shapely geometry
+        :param is_valid: Whether the geometry is valid, None if not known
+        """
+        self["geometry"] = mapping(geometry)
+        self._shape = geometry
+        self._is_valid = is_valid
+
+    @property
+    def shape(self):
+        if self._shape is None:
+            self._shape = shape(self["geometry"])
+        return self._shape
+
+    @property
+    def is_valid(self):
+        if self._is_valid is None:
+            self._is_valid = self.shape.is_valid
+        return self._is_valid
+
+    @property
+    def area(self):
+        if self._area is None:
+            self._area = self.shape.area
+        return self._area
+
+
+def as_feature(feature):
+    """ Returns a GeoJSON feature as a Feature, features that are not one
+    already are copied
+
+    :param feature: A GeoJSON feature
+    :returns: Feature
+    """
+    if isinstance(feature, Feature):
+        return feature
+    return Feature(feature)
+
+
+def get_union(geojson, processes=1):
+    """ Returns a geojson geometry that is the union of all features in a geojson feature collection
+
+    :param processes: Number of processes to union groups of features in
+    """
     shapes = []
-    for feature in geojson["features"]:
-        if feature["geometry"]["type"] not in ["Polygon", "MultiPolygon"]:
+    features = geojson["features"]
+    if isinstance(features, FeatureStore):
+        for i in features.get_polygonal_features():
+            s = features.get_shape(i)
+            shapes.extend(get_shape_union_part(s, features.is_valid(i, s)))
+    else:
+        for feature in features:
+            shapes.extend(get_union_part(feature))
+    return union_shapes(shapes, processes=processes)
+
+
+def get_union_part(feature):
+    """ Returns the simplified shape, without holes, that a feature contributes to
+    the union of a feature collection
+
+    :param feature: A GeoJSON feature
+    :returns: A list containing zero or one shapely geometries
+    """
+    if feature["geometry"]["type"] not in ["Polygon", "MultiPolygon"]:
+        return []
+
+    feature = as_feature(feature)
+    return get_shape_union_part(feature.shape, feature.is_valid)
+
+
+def get_shape_union_part(s, is_valid):
+    """ Returns the simplified shape, without holes, that the shape of a polygon
+    feature contributes to the union of a feature collection
+
+    :param s: A shapely Polygon or MultiPolygon
+    :param is_valid: Whether s is valid
+    :returns: A list containing zero or one shapely geometries
+    """
+    if s and not is_valid:
+        s = s.buffer(0.0)
+        if not s.is_valid:
+            logger.error("Invalid geometry in get_union, failed to fix")
+        else:
+            pass
+    #                logger.warning("Invalid geometry in get_union. Fixed.")
+    if s and s.is_valid:
+        # get rid of holes
+        if type(s) in (MultiPolygon, GeometryCollection):
+            hulls = [Polygon(r.exterior) for r in s.geoms]
+            hull = MultiPolygon(hulls)
+        else:
+            hull = Polygon(s.exterior)
+
+        # simplify so calculating union doesnt take forever
+        simplified = hull.simplify(0.01, preserve_topology=True)
+        if simplified.is_valid:
+            return [simplified]
+        else:
+            return [hull]
+    return []
+
+
+def union_shapes(shapes, processes=1):
+    """ Returns a geojson geometry that is the union of shapes, without holes.
+    It is a Polygon if the union has a single part, a MultiPolygon otherwise.
+
+    :param shapes: A list of shapely geometries returned by get_union_part
+    :param processes: Number of processes to union groups of shapes in, see
+        partitioned_union
+    :returns: A GeoJSON geometry
+    """
+    if processes > 1 and len(shapes) > UNION_GROUP_SIZE:
+        polygons = partitioned_union(shapes, processes=processes)
+    else:
+        polygons = get_polygons(union_group(shapes))
+
+    # get rid of holes, a single hull is a Polygon however it was unioned
+    hulls = [Polygon(r.exterior) for r in polygons]
+    if len(hulls) == 1:
+        return mapping(hulls[0])
+    return mapping(MultiPolygon(hulls))
+
+
+def partitioned_union(shapes, processes=1):
+    """ Returns the polygons of the union of shapes, unioning spatially
+    compact groups of them separately
+
+    The groups are unioned in a pool of processes. Polygons of the union of a
+    group that do not reach the envelope of another group are part of the
+    result as they are, the remaining polygons are unioned again.
+
+    :param shapes: A list of shapely geometries
+    :param processes: Number of processes to union groups in
+    """
+    groups = get_str_groups(shapes, UNION_GROUP_SIZE)
+    logger.debug("unioning %i shapes in %i groups" % (len(shapes), len(groups)))
+    if processes > 1:
+        pool = Pool(processes)
+        try:
+            unions = pool.map(union_group, groups, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        unions = [union_group(group) for group in groups]
+
+    envelopes = [union.envelope for union in unions]
+    done = []
+    remaining = []
+    for i, union in enumerate(unions):
+        neighbours = [
+            envelope
+            for j, envelope in enumerate(envelopes)
+            if j != i and envelope.intersects(envelopes[i])
+        ]
+        if not neighbours:
+            done.extend(get_polygons(union))
             continue
 
-        s = shape(feature["geometry"])
-        if s and not s.is_valid:
-            s = s.buffer(0.0)
-            if not s.is_valid:
-                logger.error("Invalid geometry in get_union, failed to fix")
-            else:
-                pass
-        #                logger.warning("Invalid geometry in get_union. Fixed.")
-        if s and s.is_valid:
-            # get rid of holes
-            if type(s) in (MultiPolygon, GeometryCollection):
-                hulls = [Polygon(r.exterior) for r in s.geoms]
-                hull = MultiPolygon(hulls)
+        reach = prep(cascaded_union(neighbours))
+        for polygon in get_polygons(union):
+            if reach.intersects(polygon):
+                remaining.append(polygon)
             else:
-                hull = Polygon(s.exterior)
+                done.append(polygon)
 
-            # simplify so calculating union doesnt take forever
-            simplified = hull.simplify(0.01, preserve_topology=True)
-            if simplified.is_valid:
-                shapes.append(simplified)
-            else:
-                shapes.append(hull)
+    if UNION_GROUP_SIZE < len(remaining) < len(shapes):
+        return done + partitioned_union(remaining, processes=processes)
+    return done + get_polygons(union_group(remaining))
+
+
+def get_polygons(geometry):
+    """ Returns the polygons of a shapely geometry
+
+    :param geometry: A shapely geometry
+    :returns: A list of shapely Polygons
+    """
+    if type(geometry) == Polygon:
+        return [] if geometry.is_empty else [geometry]
+    elif type(geometry) in (MultiPolygon, GeometryCollection):
+        return [g for g in geometry.geoms if type(g) == Polygon and not g.is_empty]
+    return []
 
+
+def union_group(shapes):
+    """ Returns the union of shapes as a shapely geometry
+
+    :param shapes: A list of shapely geometries
+    """
     try:
-        result = cascaded_union(shapes)
+        return cascaded_union(shapes)
     except Exception as e:
-        # workaround for geos bug with cacscaded_union sometimes failing
-        logger.error("cascaded_union failed, falling back to union")
-        result = shapes.pop()
-        for s in shapes:
-            result = result.union(s)
-
-    # get rid of holes
-    if type(result) in (MultiPolygon, GeometryCollection):
-        hulls = [Polygon(r.exterior) for r in result.geoms]
-        hull = MultiPolygon(hulls)
-    else:
-        hull = Polygon(result.exterior)
-
-    return mapping(hull)
+        # workaround for geos bug with cacscaded_union sometimes failing,
+        # union the halves of the group separately
+        if len(shapes) < 2:
+            raise
+        logger.error("cascaded_union failed on %i shapes, splitting them" % len(shapes))
+        middle = len(shapes) // 2
+        return union_group(shapes[:middle]).union(union_group(shapes[middle:]))
+
+
+def get_str_groups(shapes, group_size):
+    """ Split shapes into spatially compact groups, by Sort-Tile-Recursive
+    packing of the centers of their bounding boxes
+
+    :param shapes: A list of shapely geometries
+    :param group_size: Maximum number of shapes in a group
+    :returns: A list of lists of shapely geometries
+    """
+    centers = []
+    for s in shapes:
+        bounds = s.bounds or (0, 0, 0, 0)
+        centers.append(((bounds[0] + bounds[2]) / 2.0, (bounds[1] + bounds[3]) / 2.0))
+
+    group_count = int(math.ceil(len(shapes) / float(group_size)))
+    slice_count = int(math.ceil(math.sqrt(group_count)))
+    slice_size = int(math.ceil(len(shapes) / float(slice_count)))
+
+    # vertical slices ordered by x, each cut into groups ordered by y
+    order = sorted(range(len(shapes)), key=lambda i: centers[i][0])
+    groups = []
+    for start in range(0, len(order), slice_size):
+        vertical_slice = sorted(
+            order[start : start + slice_size], key=lambda i: centers[i][1]
+        )
+        for group_start in range(0, len(vertical_slice), group_size):
+            groups.append(
+                [
+                    shapes[i]
+                    for i in vertical_slice[group_start : group_start + group_size]
+                ]
+            )
+    return groups
 
 
 def polygon_from_bbox(bbox):
@@ -84,12 +314,42 @@ def polygon_from_bbox(bbox):
     ]
 
 
-def get_label_points(geojson, use_polylabel=True):
+def get_label_points(
+    geojson,
+    use_polylabel=True,
+    tolerance=POLYLABEL_TOLERANCE,
+    timeout=POLYLABEL_TIMEOUT,
+    processes=1,
+):
     """ Generate label points for polygon features 
 
     :param geojson: A GeoJSON feature collection containing Polygons or MultiPolygons
+    :param tolerance: Precision of polylabel, in web mercator meters
+    :param timeout: Seconds polylabel may spend on a polygon before the
+        centroid is used instead, or None for no limit
+    :param processes: Number of processes to run polylabel in
     :returns: A new GeoJSON Feature collection containing Point features
     """
+    polylabel = get_polylabel(use_polylabel)
+    pool = None
+    if polylabel and processes > 1 and len(geojson["features"]) >= POLYLABEL_POOL_MIN:
+        pool = Pool(processes)
+
+    try:
+        label_features = get_features_label_points(
+            geojson["features"], polylabel, tolerance, timeout, pool
+        )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return {"type": "FeatureCollection", "features": label_features}
+
+
+def get_polylabel(use_polylabel=True):
+    """ Returns the polylabel function, or None if it is not available or disabled
+    """
     if use_polylabel:
         try:
             from shapely.algorithms.polylabel import polylabel
@@ -99,111 +359,353 @@ def get_label_points(geojson, use_polylabel=True):
     else:
         logging.error("using centroid for label points, Polylabel disabled")
         polylabel = None
+    return polylabel
 
-    label_features = []
-    for feature in geojson["features"]:
-        if feature["geometry"]["type"] not in ["Polygon", "MultiPolygon"]:
-            continue
 
-        feature_geometry = shape(feature["geometry"])
+def get_feature_label_points(feature, polylabel):
+    """ Generate label points for a polygon feature
 
-        if type(feature_geometry) == MultiPolygon:
-            geometries = feature_geometry.geoms
-        else:
-            geometries = [feature_geometry]
-
-        for geometry in geometries:
-            if (
-                polylabel and geometry.is_valid
-            ):  # polylabel doesnt work on invalid geometries, centroid does
-                try:
-                    project = partial(
-                        pyproj.transform,
-                        pyproj.Proj(init="epsg:4326"),
-                        pyproj.Proj(init="epsg:3857"),
-                    )
-                    geometry_3857 = transform(project, geometry)
-                    label_geometry_3857 = polylabel(geometry_3857)
-                    project = partial(
-                        pyproj.transform,
-                        pyproj.Proj(init="epsg:3857"),
-                        pyproj.Proj(init="epsg:4326"),
-                    )
-                    label_geometry = transform(
-                        project, label_geometry_3857
-                    )  # apply projection
-                except Exception as e:
-                    logger.error(
-                        "Error getting polylabel point for feature: "
-                        + str(feature["properties"]),
-                        exc_info=e,
-                    )
-                    label_geometry = geometry.centroid
+    :param feature: A GeoJSON feature
+    :param polylabel: The polylabel function returned by get_polylabel, or None
+        to use centroids
+    :returns: A list of GeoJSON Point features, one per polygon
+    """
+    return get_features_label_points([feature], polylabel)
+
+
+def get_features_label_points(
+    features,
+    polylabel,
+    tolerance=POLYLABEL_TOLERANCE,
+    timeout=POLYLABEL_TIMEOUT,
+    pool=None,
+):
+    """ Generate label points for polygon features
+
+    Polylabel works in web mercator. The valid polygons of all features are
+    reprojected to it at once, and their label points back.
+
+    :param features: A list of GeoJSON features, or a columnar.FeatureStore
+    :param polylabel: The polylabel function returned by get_polylabel, or None
+        to use centroids
+    :param tolerance: Precision of polylabel, in web mercator meters
+    :param timeout: Seconds polylabel may spend on a polygon before the
+        centroid is used instead, or None for no limit
+    :param pool: A multiprocessing Pool to run polylabel in, or None
+    :returns: A list of GeoJSON Point features, one per polygon
+    """
+    # [properties, polygon, label point, validity] for each polygon. The
+    # validity of polygon features is that of the feature, None if not known
+    labels = []
+    if isinstance(features, FeatureStore):
+        for i in features.get_polygonal_features():
+            properties = features.get_properties(i)
+            feature_geometry = features.get_shape(i)
+            if type(feature_geometry) == MultiPolygon:
+                for geometry in feature_geometry.geoms:
+                    labels.append([properties, geometry, None, None])
+            else:
+                labels.append([properties, feature_geometry, None, features.valid[i]])
+    else:
+        for feature in features:
+            if feature["geometry"]["type"] not in ["Polygon", "MultiPolygon"]:
+                continue
+
+            feature = as_feature(feature)
+            feature_geometry = feature.shape
+            if type(feature_geometry) == MultiPolygon:
+                for geometry in feature_geometry.geoms:
+                    labels.append([feature["properties"], geometry, None, None])
             else:
-                label_geometry = geometry.centroid
+                labels.append(
+                    [feature["properties"], feature_geometry, None, feature._is_valid]
+                )
+
+    # polylabel doesnt work on invalid geometries, centroid does
+    if polylabel:
+        valid = [
+            label
+            for label in labels
+            if (label[1].is_valid if label[3] is None else label[3])
+            and not label[1].is_empty
+        ]
+    else:
+        valid = []
+    projected = transform_polygons(
+        [label[1] for label in valid], get_proj("epsg:4326"), get_proj("epsg:3857")
+    )
+    tasks = [
+        (polylabel, polygon, tolerance, timeout)
+        for polygon in projected
+        if polygon is not None
+    ]
+    if pool is not None:
+        results = pool.imap(_get_polylabel_point, tasks, chunksize=64)
+    else:
+        results = map(_get_polylabel_point, tasks)
+
+    found = []
+    points = []
+    results = iter(results)
+    for label, polygon in zip(valid, projected):
+        result = None if polygon is None else next(results)
+        if result is None or isinstance(result, str):
+            logger.error(
+                "Error getting polylabel point for feature: "
+                + str(label[0])
+                + (": " + result if result else "")
+            )
+            continue
+        found.append(label)
+        points.append(result)
+
+    if points:
+        xs, ys = pyproj.transform(
+            get_proj("epsg:3857"),
+            get_proj("epsg:4326"),
+            np.array([p[0] for p in points]),
+            np.array([p[1] for p in points]),
+        )
+        for label, x, y in zip(found, xs, ys):
+            label[2] = Point(x, y)
 
-            if label_geometry:
-                f = {
-                    "type": "Feature",
-                    "geometry": mapping(label_geometry),
-                    "properties": feature["properties"],
-                }
-                label_features.append(f)
+    label_features = []
+    for properties, geometry, label_geometry, _ in labels:
+        if label_geometry is None:
+            label_geometry = geometry.centroid
+        if label_geometry:
+            f = {
+                "type": "Feature",
+                "geometry": mapping(label_geometry),
+                "properties": properties,
+            }
+            label_features.append(f)
+
+    return label_features
+
+
+def get_proj(init):
+    """ Returns a pyproj projection for an init string such as "epsg:4326",
+    projections are created once per process
+
+    :param init: string
+    :returns: pyproj.Proj
+    """
+    proj = _projs.get(init)
+    if proj is None:
+        proj = pyproj.Proj(init=init)
+        _projs[init] = proj
+    return proj
 
-    return {"type": "FeatureCollection", "features": label_features}
 
+def transform_polygons(polygons, from_proj, to_proj):
+    """ Reproject polygons, transforming the coordinates of all of them at once
+
+    :param polygons: A list of shapely Polygons
+    :param from_proj: The pyproj projection of the polygons
+    :param to_proj: The pyproj projection to reproject to
+    :returns: A list of shapely Polygons, with None for polygons that could
+        not be reprojected
+    """
+    if not polygons:
+        return []
+    rings = []
+    lengths = []
+    for polygon in polygons:
+        polygon_rings = [polygon.exterior] + list(polygon.interiors)
+        rings.extend(np.asarray(ring.coords)[:, :2] for ring in polygon_rings)
+        lengths.append(len(polygon_rings))
+    coords = np.concatenate(rings)
+
+    try:
+        xs, ys = pyproj.transform(from_proj, to_proj, coords[:, 0], coords[:, 1])
+    except Exception:
+        if len(polygons) == 1:
+            return [None]
+        # find the polygons that fail
+        return [transform_polygons([p], from_proj, to_proj)[0] for p in polygons]
+    coords = np.column_stack((xs, ys))
+
+    transformed = []
+    start = 0
+    ring = 0
+    for count in lengths:
+        polygon_rings = []
+        for ring_coords in rings[ring : ring + count]:
+            polygon_rings.append(coords[start : start + len(ring_coords)])
+            start += len(ring_coords)
+        ring += count
+        transformed.append(Polygon(polygon_rings[0], polygon_rings[1:]))
+    return transformed
+
+
+class PolylabelTimeout(Exception):
+    pass
+
+
+def _raise_polylabel_timeout(signum, frame):
+    raise PolylabelTimeout()
+
+
+def _get_polylabel_point(task):
+    """ Returns the (x, y) polylabel point of a polygon, or an error message
+
+    :param task: A (polylabel, polygon, tolerance, timeout) tuple
+    """
+    polylabel, polygon, tolerance, timeout = task
+    alarm = (
+        timeout is not None
+        and hasattr(signal, "setitimer")
+        and threading.current_thread() is threading.main_thread()
+    )
+    if alarm:
+        handler = signal.signal(signal.SIGALRM, _raise_polylabel_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        point = polylabel(polygon, tolerance)
+        return (point.x, point.y)
+    except PolylabelTimeout:
+        return "timed out after %s seconds" % timeout
+    except Exception as e:
+        return str(e) or type(e).__name__
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, handler)
 
-def get_demo_point(geojson):
-    logging.debug("Generating demo point")
+
+def get_demo_point(geojson, envelope=None):
+    """ Find the center of the highest zoom tile containing the most rings of
+    the features in a geojson feature collection
+
+    :param geojson: A GeoJSON feature collection
+    :param envelope: The bounding box of the union of the features, computed
+        with get_union if not given
+    :returns: A (lon, lat) tuple, or None if no tile contains a ring
+    """
     logger.debug("extracting geometry rings")
-    geometries = []
-    for feature in geojson["features"]:
-        if feature["geometry"]["type"] == "Polygon":
-            rings = feature["geometry"]["coordinates"]
-        elif feature["geometry"]["type"] == "MultiPolygon":
-            rings = []
-            for p in feature["geometry"]["coordinates"]:
-                rings.extend(p)
-
-        for ring in rings:
-            s = LineString(ring)
-            geometries.append(s)
-
-    logger.debug("Inserting into index")
-
-    def generator_function():
-        for i, obj in enumerate(geometries):
-            yield (
-                i,
-                obj.bounds,
-                i,
-            )  # Buffer geometry so it comes up in intersection queries
-
-    spatial_index = index.Index(generator_function())
+    features = geojson["features"]
+    if isinstance(features, FeatureStore):
+        ring_indexes, _ = features.get_rings(features.get_polygonal_features())
+        ring_indexes = ring_indexes[features.get_ring_lengths(ring_indexes) > 0]
+        ring_bounds = features.get_rings_bounds(ring_indexes)
+        rings = [features.coords[features.get_ring_slice(r)] for r in ring_indexes]
+    else:
+        rings = []
+        for feature in features:
+            rings.extend(ring for ring in get_feature_rings(feature) if ring)
+        ring_bounds = get_rings_bounds(rings)
+
+    if envelope is None:
+        envelope = shape(get_union(geojson)).bounds
+    return get_demo_point_for_rings(ring_bounds, envelope, rings=rings)
+
+
+def get_feature_rings(feature):
+    """ Returns the coordinates of the rings of a polygon feature
+
+    :param feature: A GeoJSON feature
+    :returns: A list of rings, each a list of coordinates
+    """
+    if feature["geometry"]["type"] == "Polygon":
+        return feature["geometry"]["coordinates"]
+    elif feature["geometry"]["type"] == "MultiPolygon":
+        rings = []
+        for p in feature["geometry"]["coordinates"]:
+            rings.extend(p)
+        return rings
+    return []
+
+
+def get_rings_bounds(rings):
+    """ Returns the bounding boxes of rings
+
+    :param rings: A list of rings, each a non empty list of coordinates
+    :returns: A numpy array with a (minx, miny, maxx, maxy) row per ring
+    """
+    if not rings:
+        return np.empty((0, 4))
+    lengths = np.array([len(ring) for ring in rings])
+    count = int(lengths.sum())
+    xs = np.fromiter((c[0] for ring in rings for c in ring), float, count)
+    ys = np.fromiter((c[1] for ring in rings for c in ring), float, count)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    return np.column_stack(
+        (
+            np.minimum.reduceat(xs, offsets),
+            np.minimum.reduceat(ys, offsets),
+            np.maximum.reduceat(xs, offsets),
+            np.maximum.reduceat(ys, offsets),
+        )
+    )
+
+
+def get_demo_point_for_rings(ring_bounds, envelope, rings=None):
+    """ Find the center of the highest zoom tile containing the most rings
+
+    Starting at zoom 8 over the envelope, each zoom searches the tiles of the
+    best tile of the previous zoom. Ties go to the first tile in the order of
+    mercantile.tiles.
+
+    :param ring_bounds: A list or array of ring bounding boxes
+    :param envelope: The bounding box to search for tiles in
+    :param rings: A list of rings matching ring_bounds, each a list of
+        coordinates. Tiles are scored by the rings they intersect, or by the
+        ring bounding boxes they intersect if not given.
+    :returns: A (lon, lat) tuple, or None if no tile contains a ring
+    """
+    bounds = np.asarray(ring_bounds, dtype=float).reshape(-1, 4)
+    lines = {}
+
+    def count_ring_intersections(tile):
+        tile_bounds = mercantile.bounds(tile.x, tile.y, tile.z)
+        tile_geometry = prep(Polygon(polygon_from_bbox(tile_bounds)[0]))
+        count = 0
+        for i in np.flatnonzero(get_bounds_intersecting(bounds, tile_bounds)):
+            if i not in lines:
+                lines[i] = LineString(rings[i])
+            if tile_geometry.intersects(lines[i]):
+                count += 1
+        return count
 
     best_tile = None
     best_tile_feature_count = 0
-    envelope = shape(get_union(geojson)).bounds
     logger.debug("Iterating tiles to find best tile")
 
     for zoom in range(8, 17):
-        best_tile_feature_count = 0
         if best_tile:
             envelope = mercantile.bounds(best_tile.x, best_tile.y, best_tile.z)
-        for tile in mercantile.tiles(
-            envelope[0], envelope[1], envelope[2], envelope[3], [zoom]
-        ):
-            tile_bounds = mercantile.bounds(tile.x, tile.y, tile.z)
-            tile_features = [i for i in spatial_index.intersection(tile_bounds)]
-            if len(tile_features) > best_tile_feature_count:
-                tile_bounds_geometry = Polygon(polygon_from_bbox(tile_bounds)[0])
-                tile_feature_count = 0
-                for i in tile_features:
-                    if tile_bounds_geometry.intersects(geometries[i]):
-                        tile_feature_count += 1
-                if tile_feature_count > best_tile_feature_count:
-                    best_tile_feature_count = tile_feature_count
-                    best_tile = tile
+        tiles = list(
+            mercantile.tiles(envelope[0], envelope[1], envelope[2], envelope[3], [zoom])
+        )
+        if not tiles:
+            continue
+        counts = get_tile_bounds_counts(bounds, tiles)
+
+        if rings is None:
+            i = int(np.argmax(counts))
+            if counts[i] > 0:
+                best_tile = tiles[i]
+                best_tile_feature_count = int(counts[i])
+            continue
+
+        # a tile intersects at most as many rings as ring bounding boxes, so
+        # only tiles with more bounding boxes than the best exact count so
+        # far need to be checked exactly
+        best = None
+        best_count = 0
+        for i in sorted(range(len(tiles)), key=lambda i: (-counts[i], i)):
+            if counts[i] < best_count or counts[i] == 0:
+                break
+            if counts[i] == best_count and i > best:
+                continue
+            count = count_ring_intersections(tiles[i])
+            if count > best_count or (count == best_count and count and i < best):
+                best = i
+                best_count = count
+        if best is not None:
+            best_tile = tiles[best]
+            best_tile_feature_count = best_count
 
     if best_tile:
         logger.debug(
@@ -222,20 +724,92 @@ def get_demo_point(geojson):
         logger.error("Found 0 tiles with features")
 
 
-def _explode(coords):
-    """Explode a GeoJSON geometry's coordinates object and
-    yield coordinate tuples. As long as the input is conforming,
-    the type of the geometry doesn't matter.
+def get_bounds_intersecting(bounds, bbox):
+    """ Returns which bounding boxes intersect or touch a bounding box
 
-    From @sgillies answer: http://gis.stackexchange.com/a/90554/27367
+    :param bounds: A numpy array of (minx, miny, maxx, maxy) rows
+    :param bbox: A (minx, miny, maxx, maxy) bounding box
+    :returns: A numpy boolean array
     """
-    for e in coords:
-        if isinstance(e, (float, int)):
-            yield coords
-            break
-        else:
-            for f in _explode(e):
-                yield f
+    return (
+        (bounds[:, 0] <= bbox[2])
+        & (bounds[:, 1] <= bbox[3])
+        & (bounds[:, 2] >= bbox[0])
+        & (bounds[:, 3] >= bbox[1])
+    )
+
+
+def get_tile_bounds_counts(bounds, tiles):
+    """ Count the bounding boxes intersecting or touching each of a set of tiles
+    of one zoom
+
+    The tiles span a grid of columns and rows. Each bounding box covers a
+    range of columns and rows, found by binary search of the tile edges, and
+    the counts of all tiles are summed from the corners of these ranges.
+
+    :param bounds: A numpy array of (minx, miny, maxx, maxy) rows
+    :param tiles: A list of mercantile tiles of the same zoom
+    :returns: A numpy array of counts matching tiles
+    """
+    zoom = tiles[0].z
+    x0 = min(t.x for t in tiles)
+    x1 = max(t.x for t in tiles)
+    y0 = min(t.y for t in tiles)
+    y1 = max(t.y for t in tiles)
+    columns = [mercantile.bounds(x, y0, zoom) for x in range(x0, x1 + 1)]
+    rows = [mercantile.bounds(x0, y, zoom) for y in range(y0, y1 + 1)]
+    west = np.array([b.west for b in columns])
+    east = np.array([b.east for b in columns])
+    # rows run south, negate latitudes so they increase
+    north = -np.array([b.north for b in rows])
+    south = -np.array([b.south for b in rows])
+
+    first_column = np.searchsorted(east, bounds[:, 0], "left")
+    last_column = np.searchsorted(west, bounds[:, 2], "right") - 1
+    first_row = np.searchsorted(south, -bounds[:, 3], "left")
+    last_row = np.searchsorted(north, -bounds[:, 1], "right") - 1
+    covering = (first_column <= last_column) & (first_row <= last_row)
+    first_column = first_column[covering]
+    last_column = last_column[covering] + 1
+    first_row = first_row[covering]
+    last_row = last_row[covering] + 1
+
+    # add 1 inside each range, as differences at its corners
+    shape_ = (len(rows) + 1, len(columns) + 1)
+    corners = np.concatenate(
+        (
+            np.ravel_multi_index((first_row, first_column), shape_),
+            np.ravel_multi_index((first_row, last_column), shape_),
+            np.ravel_multi_index((last_row, first_column), shape_),
+            np.ravel_multi_index((last_row, last_column), shape_),
+        )
+    )
+    signs = np.repeat([1, -1, -1, 1], len(first_row))
+    grid = np.bincount(corners, weights=signs, minlength=shape_[0] * shape_[1])
+    grid = grid.reshape(shape_).cumsum(axis=0).cumsum(axis=1)
+    return np.array([grid[t.y - y0, t.x - x0] for t in tiles], dtype=int)
+
+
+def get_positions(coordinates):
+    """ Returns the positions in a GeoJSON geometry's coordinates object as a
+    flat list. As long as the input is conforming, the type of the geometry
+    doesn't matter.
+
+    :param coordinates: The coordinates of a GeoJSON geometry
+    :returns: A list of positions
+    """
+    # positions are nested equally deep in a geometry, find the depth once
+    # instead of checking every element
+    depth = 0
+    first = coordinates
+    while first and isinstance(first[0], (list, tuple)):
+        first = first[0]
+        depth += 1
+    if depth == 0:
+        return [coordinates]
+    for _ in range(depth - 1):
+        coordinates = chain.from_iterable(coordinates)
+    return list(coordinates)
 
 
 def get_bbox_from_geojson_feature(feature):
@@ -251,7 +825,9 @@ def get_bbox_from_geojson_geometry(geometry):
     :param geojson: GeoJSON Geometry
     :returns: a 4 float bounding box, ESWN
      """
-    x, y = list(zip(*list(_explode(geometry["coordinates"]))))
+    positions = get_positions(geometry["coordinates"])
+    x = [p[0] for p in positions]
+    y = [p[1] for p in positions]
     return min(x), min(y), max(x), max(y)
 
 
@@ -269,7 +845,8 @@ def get_bbox_from_geojson(geojson):
 
 
 def get_bbox_from_geojson_feature_collection(geojson):
-    """ Generate a bounding box for GeoJson FeatureCollection
+    """ Generate a bounding box for GeoJson FeatureCollection, from the bbox of
+    its features where they have one
     :param geojson: a GeoJson FeatureCollection
     :returns: a 4 float bounding box, ESWN
      """
@@ -277,8 +854,17 @@ def get_bbox_from_geojson_feature_collection(geojson):
     features = geojson["features"]
     if len(features) == 0:
         return None
-    elif len(features) == 1:
-        return get_bbox_from_geojson_feature(features[0])
+
+    if isinstance(features, FeatureStore):
+        bboxes = features.bboxes
+        if bboxes is None:
+            bboxes = features.get_bboxes()
+        return (
+            float(np.nanmin(bboxes[:, 0])),
+            float(np.nanmin(bboxes[:, 1])),
+            float(np.nanmax(bboxes[:, 2])),
+            float(np.nanmax(bboxes[:, 3])),
+        )
 
     feature_bboxes = []
     for feature in features:
@@ -316,3 +902,117 @@ def get_area_acres(geometry):
         shapely_geometry,
     )
     return round(geom_aea.area / 4046.8564224)
+
+
+def get_areas_acres(geometries):
+    """ Calculate areas in acres for GeoJSON geometries at once
+
+    The coordinates of all polygons are reprojected with a single Albers equal
+    area projection fitted to their latitudes, and the areas of their rings
+    are computed with the shoelace formula. Geometries other than Polygons and
+    MultiPolygons fall back to get_area_acres.
+
+    :param geometries: A list of GeoJSON geometries
+    :returns: A list of areas in acres
+    """
+    xs = []
+    ys = []
+    lengths = []
+    # +1 for exteriors and -1 for holes, and the geometry of each ring
+    signs = []
+    owners = []
+    areas = [None] * len(geometries)
+    for i, geometry in enumerate(geometries):
+        if geometry["type"] == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry["type"] == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            areas[i] = get_area_acres(geometry)
+            continue
+        areas[i] = 0
+        for polygon in polygons:
+            for j, ring in enumerate(polygon):
+                if len(ring) < 3:
+                    continue
+                xs.extend(c[0] for c in ring)
+                ys.extend(c[1] for c in ring)
+                lengths.append(len(ring))
+                signs.append(-1.0 if j else 1.0)
+                owners.append(i)
+
+    if not lengths:
+        return areas
+
+    sums = get_rings_area_sums(
+        np.array(xs), np.array(ys), lengths, signs, owners, len(geometries)
+    )
+    for i, area in enumerate(sums):
+        if areas[i] == 0:
+            areas[i] = round(float(area) / 4046.8564224)
+    return areas
+
+
+def get_feature_store_areas_acres(store):
+    """ Calculate areas in acres for the features of a columnar.FeatureStore,
+    like get_areas_acres but from the position arrays of the store
+
+    :param store: A columnar.FeatureStore
+    :returns: A list of areas in acres
+    """
+    areas = [None] * len(store)
+    polygonal = store.get_polygonal_features()
+    for i in set(range(len(store))) - set(polygonal):
+        areas[i] = get_area_acres(store.get_geometry(i))
+    for i in polygonal:
+        areas[i] = 0
+
+    rings, owners = store.get_rings(polygonal)
+    lengths = store.get_ring_lengths(rings)
+    signs = np.where(store.get_exterior_rings(rings), 1.0, -1.0)
+    keep = lengths >= 3
+    rings = rings[keep]
+    if not len(rings):
+        return areas
+
+    coords = store.get_rings_coords(rings)
+    sums = get_rings_area_sums(
+        np.ascontiguousarray(coords[:, 0]),
+        np.ascontiguousarray(coords[:, 1]),
+        lengths[keep],
+        signs[keep],
+        owners[keep],
+        len(store),
+    )
+    for i in polygonal:
+        areas[i] = round(float(sums[i]) / 4046.8564224)
+    return areas
+
+
+def get_rings_area_sums(xs, ys, lengths, signs, owners, count):
+    """ Returns the areas of rings in EPSG:4326, in square meters of an Albers
+    equal area projection fitted to their latitudes, summed per owner
+
+    :param xs: A numpy array of the longitudes of the rings, one after the other
+    :param ys: A numpy array of the latitudes of the rings
+    :param lengths: The number of positions of each ring
+    :param signs: +1 for each exterior ring and -1 for each hole
+    :param owners: The index of the geometry of each ring
+    :param count: The number of geometries
+    :returns: A numpy array of areas per geometry
+    """
+    aea = pyproj.Proj(proj="aea", lat1=ys.min(), lat2=ys.max())
+    xs, ys = pyproj.transform(get_proj("epsg:4326"), aea, xs, ys)
+
+    lengths = np.asarray(lengths)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    # the vertex following each vertex, closing each ring
+    following = np.arange(1, len(xs) + 1)
+    following[starts + lengths - 1] = starts
+    # offset by the first vertex of each ring, for precision
+    x0 = np.repeat(xs[starts], lengths)
+    y0 = np.repeat(ys[starts], lengths)
+    cross = (xs - x0) * (ys[following] - y0) - (xs[following] - x0) * (ys - y0)
+    ring_areas = np.abs(np.add.reduceat(cross, starts)) / 2.0
+
+    return np.bincount(owners, weights=ring_areas * signs, minlength=count)
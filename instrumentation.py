@@ -0,0 +1,163 @@
+import logging
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+
+def get_peak_rss():
+    """Returns the peak resident set size of this process in bytes.
+
+    :returns: int
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    if sys.platform != "darwin":
+        peak *= 1024
+    return peak
+
+
+class SourceStats(object):
+    """Records wall time, CPU time, memory, bytes downloaded and feature
+    counts for the stages of processing a source.
+
+    The peak RSS of a process only ever grows, so a stage records how much it
+    raised the peak, as "peak_rss_growth", and the peak of the process when it
+    ended, as "process_peak_rss". A stage that stays below an earlier peak has
+    no growth. CPU time and memory are process wide, so they include work
+    done by other threads while the stage ran. Stages named
+    "<stage>.<substage>" break down the time of an enclosing stage and are
+    not counted in the source totals.
+    """
+
+    def __init__(self, path):
+        super(SourceStats, self).__init__()
+        self.path = path
+        self.stages = []
+
+    def record(
+        self, name, wall, cpu, features=None, byte_count=None, peak_rss_growth=0
+    ):
+        """Record a stage, adding to it if it was already recorded.
+
+        :param name: string
+        :param wall: float, wall time in seconds
+        :param cpu: float, CPU time in seconds
+        :param features: int, number of features the stage handled
+        :param byte_count: int, number of bytes the stage downloaded
+        :param peak_rss_growth: int, bytes the stage raised the peak RSS of
+            the process by
+        """
+        for stage in self.stages:
+            if stage["stage"] == name:
+                break
+        else:
+            stage = {
+                "stage": name,
+                "wall": 0.0,
+                "cpu": 0.0,
+                "peak_rss_growth": 0,
+                "process_peak_rss": 0,
+                "features": None,
+                "bytes": None,
+            }
+            self.stages.append(stage)
+
+        stage["wall"] += wall
+        stage["cpu"] += cpu
+        stage["peak_rss_growth"] += peak_rss_growth
+        stage["process_peak_rss"] = get_peak_rss()
+        if features is not None:
+            stage["features"] = (stage["features"] or 0) + features
+        if byte_count is not None:
+            stage["bytes"] = (stage["bytes"] or 0) + byte_count
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager timing a stage. It yields a dict, set its
+        "features" or "bytes" keys to record counts for the stage.
+
+        :param name: string
+        """
+        counts = {}
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        start_peak_rss = get_peak_rss()
+        try:
+            yield counts
+        finally:
+            self.record(
+                name,
+                time.perf_counter() - start_wall,
+                time.process_time() - start_cpu,
+                features=counts.get("features"),
+                byte_count=counts.get("bytes"),
+                peak_rss_growth=get_peak_rss() - start_peak_rss,
+            )
+
+    def to_dict(self):
+        top_level = [s for s in self.stages if "." not in s["stage"]]
+        return {
+            "path": self.path,
+            "wall": sum(s["wall"] for s in top_level),
+            "cpu": sum(s["cpu"] for s in top_level),
+            "stages": self.stages,
+        }
+
+
+def get_report(source_stats):
+    """Returns a report of the stats of all processed sources, with totals
+    per stage. Its "peak_rss" is the highest peak RSS of the processes that
+    ran the stages.
+
+    :param source_stats: list of dicts returned by SourceStats.to_dict
+    :returns: dict
+    """
+    totals = {}
+    for source in source_stats:
+        for stage in source["stages"]:
+            total = totals.setdefault(
+                stage["stage"],
+                {"stage": stage["stage"], "wall": 0.0, "cpu": 0.0, "sources": 0},
+            )
+            total["wall"] += stage["wall"]
+            total["cpu"] += stage["cpu"]
+            total["sources"] += 1
+
+    return {
+        "sources": source_stats,
+        "stages": sorted(totals.values(), key=lambda s: s["wall"], reverse=True),
+        "peak_rss": max(
+            [s["process_peak_rss"] for source in source_stats for s in source["stages"]]
+            or [0]
+        ),
+    }
+
+
+def log_summary(report, count=10):
+    """Log tables of the slowest stages and sources in a report.
+
+    :param report: dict returned by get_report
+    :param count: int, number of sources to list
+    """
+    lines = ["{:<20} {:>10} {:>10} {:>8}".format("stage", "wall", "cpu", "sources")]
+    for stage in report["stages"]:
+        lines.append(
+            "{:<20} {:>10.2f} {:>10.2f} {:>8}".format(
+                stage["stage"], stage["wall"], stage["cpu"], stage["sources"]
+            )
+        )
+    logging.info("Time per stage:\n" + "\n".join(lines))
+
+    slowest = sorted(report["sources"], key=lambda s: s["wall"], reverse=True)
+    lines = ["{:<50} {:>10} {:<20}".format("source", "wall", "slowest stage")]
+    for source in slowest[:count]:
+        stage = max(source["stages"], key=lambda s: s["wall"], default=None)
+        lines.append(
+            "{:<50} {:>10.2f} {:<20}".format(
+                source["path"],
+                source["wall"],
+                "" if stage is None else "%s (%.2f)" % (stage["stage"], stage["wall"]),
+            )
+        )
+    logging.info("Slowest sources:\n" + "\n".join(lines))
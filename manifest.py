@@ -0,0 +1,294 @@
+import ast
+import hashlib
+import logging
+import os
+
+import ujson
+
+import utils
+
+# hidden, like the .exploded state directory, so the manifest and the
+# upstream validators it records are not published with the output
+MANIFEST_FILENAME = ".manifest.json"
+# changes to the manifest recorded during a run, see ManifestWriter
+MANIFEST_JOURNAL_FILENAME = ".manifest.journal"
+# name the manifest was written under before it was hidden
+LEGACY_MANIFEST_FILENAME = "manifest.json"
+MANIFEST_VERSION = 1
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# script generating the output, it and the local modules it imports make up
+# the code whose behaviour affects generated output
+CODE_ENTRY_POINT = "process.py"
+
+_code_version = None
+
+
+def hash_file(path):
+    """Returns the sha256 hex digest of a file's contents.
+
+    :param path: string
+    :returns: string
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_code_paths(root, entry_point=CODE_ENTRY_POINT):
+    """Returns the paths of a script and of the local modules it imports,
+    directly or through other local modules. Imports are read from the
+    source, so modules imported inside functions are included too.
+
+    :param root: string, directory of the script and local modules
+    :param entry_point: string, path of the script relative to root
+    :returns: sorted list of paths relative to root
+    """
+    paths = set()
+    pending = [entry_point]
+    while pending:
+        path = pending.pop()
+        if path in paths:
+            continue
+        paths.add(path)
+        with open(os.path.join(root, path)) as f:
+            tree = ast.parse(f.read(), path)
+        package = os.path.dirname(path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                base = ""
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom):
+                base = ""
+                if node.level:
+                    base = package
+                    for _ in range(node.level - 1):
+                        base = os.path.dirname(base)
+                # the imported names may be modules of a package
+                prefix = node.module + "." if node.module else ""
+                names = [prefix + alias.name for alias in node.names]
+                if node.module:
+                    names.append(node.module)
+            else:
+                continue
+            for name in names:
+                module_path = _find_module(root, base, name)
+                if module_path is not None:
+                    pending.append(module_path)
+    return sorted(paths)
+
+
+def _find_module(root, base, name):
+    """Returns the path relative to root of the local module a dotted name
+    refers to, from the package directory base, or None."""
+    module_path = os.path.join(base, *name.split("."))
+    for path in (module_path + ".py", os.path.join(module_path, "__init__.py")):
+        if os.path.isfile(os.path.join(root, path)):
+            return path
+    return None
+
+
+def get_code_version():
+    """Returns a hash of the processing code, so output generated by a
+    different version of the code is considered outdated.
+
+    :returns: string
+    """
+    global _code_version
+    if _code_version is None:
+        root = os.path.dirname(os.path.abspath(__file__))
+        digest = hashlib.sha256()
+        for path in get_code_paths(root):
+            digest.update(path.encode())
+            digest.update(hash_file(os.path.join(root, path)).encode())
+        _code_version = digest.hexdigest()
+    return _code_version
+
+
+def read_manifest(output):
+    """Returns the source entries of the build manifest in an output
+    directory, with the changes journaled since it was written, or an empty
+    dict if there is no usable manifest.
+
+    :param output: string
+    :returns: dict
+    """
+    entries = {}
+    path = os.path.join(output, MANIFEST_FILENAME)
+    if not os.path.isfile(path):
+        path = os.path.join(output, LEGACY_MANIFEST_FILENAME)
+    if os.path.isfile(path):
+        try:
+            manifest = utils.read_json(path)
+        except ValueError:
+            logging.warning("Ignoring unreadable build manifest " + path)
+            return {}
+        if manifest.get("version") != MANIFEST_VERSION:
+            logging.warning("Ignoring build manifest with unknown version " + path)
+            return {}
+        entries = manifest["sources"]
+
+    journal_path = os.path.join(output, MANIFEST_JOURNAL_FILENAME)
+    if os.path.isfile(journal_path):
+        with open(journal_path, "r") as f:
+            for line in f:
+                try:
+                    change = ujson.loads(line)
+                except ValueError:
+                    # the last change of an interrupted run may be partial
+                    logging.warning("Ignoring partial change in " + journal_path)
+                    break
+                if change["entry"] is None:
+                    entries.pop(change["key"], None)
+                else:
+                    entries[change["key"]] = change["entry"]
+    return entries
+
+
+def write_manifest(output, entries):
+    """Atomically write the build manifest to an output directory, removing
+    a manifest left under its legacy name.
+
+    :param output: string
+    :param entries: dict of manifest entries keyed by output path
+    """
+    path = os.path.join(output, MANIFEST_FILENAME)
+    manifest = {"version": MANIFEST_VERSION, "sources": entries}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(ujson.dumps(manifest, escape_forward_slashes=False, indent=2))
+    os.replace(tmp_path, path)
+    legacy_path = os.path.join(output, LEGACY_MANIFEST_FILENAME)
+    if os.path.isfile(legacy_path):
+        os.remove(legacy_path)
+
+
+class ManifestWriter(object):
+    """Records the manifest entries of the sources of a run as they are built.
+
+    Each change is appended to a journal next to the manifest, so a run
+    writes every entry once, and an interrupted run keeps the entries it
+    recorded. The journal is folded into the manifest when the writer is
+    closed.
+    """
+
+    def __init__(self, output, entries):
+        """
+        :param output: string
+        :param entries: dict of manifest entries returned by read_manifest
+        """
+        super(ManifestWriter, self).__init__()
+        self.output = output
+        self.entries = dict(entries)
+        # entries replayed from the journal of an interrupted run are folded
+        # in first, so the new journal does not follow a partial change
+        write_manifest(output, self.entries)
+        self.journal_path = os.path.join(output, MANIFEST_JOURNAL_FILENAME)
+        self.journal = open(self.journal_path, "w")
+
+    def set(self, key, entry):
+        """Record the entry of a source.
+
+        :param key: string, output path of the source
+        :param entry: dict returned by make_entry
+        """
+        if self.entries.get(key) != entry:
+            self.entries[key] = entry
+            self._append(key, entry)
+
+    def remove(self, key):
+        """Remove the entry of a source, if it has one.
+
+        :param key: string, output path of the source
+        """
+        if key in self.entries:
+            del self.entries[key]
+            self._append(key, None)
+
+    def _append(self, key, entry):
+        change = {"key": key, "entry": entry}
+        self.journal.write(ujson.dumps(change, escape_forward_slashes=False) + "\n")
+        self.journal.flush()
+
+    def close(self):
+        """Write the manifest with all recorded entries and remove the
+        journal."""
+        self.journal.close()
+        write_manifest(self.output, self.entries)
+        os.remove(self.journal_path)
+
+
+def get_options(stream=False, compress=None, geometry_jobs=1):
+    """Returns the processing options that affect generated output, so output
+    generated with other options is considered outdated.
+
+    --columnar is not recorded, it writes the same output as the default.
+
+    :param stream: bool, whether sources are processed with --stream, which
+        changes the order of merged features and how the demo point is chosen
+    :param compress: list of codecs compressed copies are written with
+    :param geometry_jobs: int, number of processes the geometry of a source
+        is unioned in. Only whether it is more than one is recorded, as the
+        parts of a partitioned union can come out in another order
+    :returns: dict
+    """
+    return {
+        "stream": stream,
+        "compress": sorted(compress or []),
+        "partitioned_union": geometry_jobs > 1,
+    }
+
+
+def make_entry(source_hash, download_hash, validators, options=None):
+    """Returns a manifest entry describing the inputs of a build.
+
+    :param source_hash: string, hash of the source JSON file
+    :param download_hash: string, hash of the downloaded data
+    :param validators: dict of HTTP validators for the downloaded data
+    :param options: dict returned by get_options
+    :returns: dict
+    """
+    return {
+        "source": source_hash,
+        "download": download_hash,
+        "validators": validators,
+        "code": get_code_version(),
+        "options": options or get_options(),
+    }
+
+
+def source_unchanged(entry, source_hash, options=None):
+    """Returns True if an entry was built from the same source JSON with the
+    same version of the code and the same options.
+
+    :param entry: dict or None
+    :param source_hash: string
+    :param options: dict returned by get_options
+    """
+    return (
+        entry is not None
+        and entry.get("source") == source_hash
+        and entry.get("code") == get_code_version()
+        and entry.get("options") == (options or get_options())
+    )
+
+
+def validators_unchanged(entry, validators):
+    """Returns True if the upstream HTTP validators match the ones recorded in
+    an entry. Missing validators never match.
+
+    :param entry: dict
+    :param validators: dict
+    """
+    return bool(validators) and entry.get("validators") == validators
+
+
+def download_unchanged(entry, download_hash):
+    """Returns True if the downloaded data hashes to the recorded value.
+
+    :param entry: dict
+    :param download_hash: string
+    """
+    return entry.get("download") == download_hash
@@ -1,61 +1,157 @@
-from shapely.geometry import mapping
-from shapely.geometry import shape
+import logging
+from multiprocessing import Pool
+
 from shapely.ops import cascaded_union
+from shapely.strtree import STRtree
 
 import geoutils
 
+logger = logging.getLogger("processing")
+
+# minimum number of features to merge to union groups in a pool of processes
+MERGE_POOL_MIN = 1000
+
 
-def merge_features(geojson, merge_field, properties_key="properties"):
+def merge_features(
+    geojson,
+    merge_field,
+    properties_key="properties",
+    processes=1,
+    adjacent_only=False,
+):
     """ Merge features based on matching properties
 
+    Features are grouped by their merge_field value in a single pass and each
+    group is unioned on its own. A merged feature has the properties of the
+    largest of the features of its group, other than the last one. Groups
+    come out in reverse order of their last feature.
+
     :param geojson: A GeoJSON feature collection containing Polygons or MultiPolygons
+    :param processes: Number of processes to union groups in, if there are at
+        least MERGE_POOL_MIN features to merge
+    :param adjacent_only: Only merge features that touch or overlap, directly
+        or through other features of their group, see get_adjacent_components
     :returns: A new GeoJSON Feature collection containing Polygons or MultiPolygons
     """
-    output_features = []
+    features = [geoutils.as_feature(f) for f in geojson["features"]]
+    if adjacent_only:
+        keys = get_adjacent_components(features, merge_field, properties_key)
+    else:
+        keys = [f[properties_key][merge_field] for f in features]
+
+    groups = {}
+    last = {}
+    for i, (feature, key) in enumerate(zip(features, keys)):
+        groups.setdefault(key, []).append(feature)
+        last[key] = i
 
-    input_features = geojson["features"]
-    while len(input_features) > 0:
-        feature = input_features.pop()
-        shapes = []
-        shapes.append(shape(feature["geometry"]))
-
-        to_merge = [
-            f
-            for f in input_features
-            if f[properties_key][merge_field] == feature[properties_key][merge_field]
-        ]
-        if len(to_merge) == 0:
-            output_features.append(feature)
+    output_features = []
+    merged = []
+    tasks = []
+    for key in sorted(last, key=last.get, reverse=True):
+        group = groups.pop(key)
+        if len(group) == 1:
+            output_features.append(group[0])
             continue
 
+        # the last feature, then the others in order
+        members = group[-1:] + group[:-1]
         largest = None
-        for f in to_merge:
-            input_features.remove(f)
-            f_geom = shape(f["geometry"])
-            shapes.append(f_geom)
-            if largest is None or f_geom.area > largest["geometry"].area:
-                largest = {"geometry": f_geom, "properties": f["properties"]}
-
-        # Fix invalid geometries
-        shapes = [s.buffer(0.0) if not s.is_valid else s for s in shapes]
-
-        try:
-            result = cascaded_union(shapes)
-        except Exception as e:
-            # workaround for geos bug with cacscaded_union sometimes failing
-            logger.error("cascaded_union failed, falling back to union")
-            result = shapes.pop()
-            for s in shapes:
-                result = result.union(s)
-
-        result_feature = {
-            "type": "Feature",
-            "properties": largest["properties"],
-            "geometry": mapping(result),
-        }
+        for f in members[1:]:
+            if largest is None or f.area > largest.area:
+                largest = f
+
+        result_feature = geoutils.Feature(
+            type="Feature", properties=largest["properties"]
+        )
         output_features.append(result_feature)
+        merged.append(result_feature)
+        tasks.append(([f.shape for f in members], [f.is_valid for f in members]))
+
+    pool = None
+    if processes > 1 and sum(len(task[0]) for task in tasks) >= MERGE_POOL_MIN:
+        pool = Pool(processes)
+    try:
+        if pool is not None:
+            chunksize = max(1, len(tasks) // (processes * 4))
+            results = pool.imap(_merge_task, tasks, chunksize=chunksize)
+        else:
+            results = map(_merge_task, tasks)
+        for result_feature, result in zip(merged, results):
+            result_feature.set_shape(result)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     output = {"type": "FeatureCollection", "features": output_features}
     if "properties" in geojson:
         output["properties"] = geojson["properties"]
     return output
+
+
+def get_adjacent_components(features, merge_field, properties_key="properties"):
+    """ Find the groups of features that share a merge_field value and are
+    connected by touching or overlapping each other
+
+    Candidate pairs come from an STR tree of the bounding boxes of all
+    features, and connected features are joined with a union-find.
+
+    :param features: A list of geoutils.Feature
+    :returns: A list of the group of each feature, as the index of one of the
+        features of the group
+    """
+    values = [f[properties_key][merge_field] for f in features]
+    # invalid shapes may fail intersection tests, use them fixed
+    shapes = [f.shape if f.is_valid else f.shape.buffer(0.0) for f in features]
+    indexes = {id(s): i for i, s in enumerate(shapes)}
+    parents = list(range(len(features)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    tree_shapes = [s for s in shapes if not s.is_empty]
+    if tree_shapes:
+        tree = STRtree(tree_shapes)
+        for i, s in enumerate(shapes):
+            if s.is_empty:
+                continue
+            for candidate in tree.query(s):
+                j = indexes[id(candidate)]
+                if j <= i or values[j] != values[i]:
+                    continue
+                root_i = find(i)
+                root_j = find(j)
+                if root_i != root_j and s.intersects(candidate):
+                    parents[max(root_i, root_j)] = min(root_i, root_j)
+
+    return [find(i) for i in range(len(features))]
+
+
+def _merge_task(task):
+    return merge_shapes(*task)
+
+
+def merge_shapes(shapes, valid):
+    """ Returns the union of the shapes of a group of features
+
+    :param shapes: A list of shapely geometries
+    :param valid: A list of whether each shape is valid, invalid shapes are
+        fixed before the union
+    :returns: A shapely geometry
+    """
+    # Fix invalid geometries
+    shapes = [s if v else s.buffer(0.0) for s, v in zip(shapes, valid)]
+
+    try:
+        return cascaded_union(shapes)
+    except Exception as e:
+        # workaround for geos bug with cacscaded_union sometimes failing
+        logger.error("cascaded_union failed, falling back to union")
+        result = shapes.pop()
+        for s in shapes:
+            result = result.union(s)
+        return result
@@ -0,0 +1,108 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+POLL_INTERVAL = 0.5
+
+
+class Prefetcher(object):
+    """Iterable that runs a fetch function over items in a thread pool, up to
+    `ahead` items ahead of the consumer, and yields the results in order.
+
+    An item is held from the start of its fetch until the consumer calls
+    release for it, and at most `ahead` + `consumers` items are held at once.
+    Results taken from the iterator but not yet used, as by the task handler
+    of a multiprocessing pool, are still held, so no more than `ahead` results
+    wait for one of `consumers` workers. The consumer must call release once
+    for each result it is done with.
+
+    Fetched files count against `max_bytes` until the consumer removes them.
+    No new fetch is started while the files on disk exceed the budget, so the
+    consumer must remove each file once it is done with it.
+    """
+
+    def __init__(
+        self, fetch, items, get_filename, ahead=2, max_bytes=None, consumers=1
+    ):
+        """
+        :param fetch: function called with each item, run in a worker thread
+        :param items: iterable of items to fetch
+        :param get_filename: function returning the path of the file a fetch
+            result holds on disk, or None
+        :param ahead: maximum number of items fetched ahead of the consumer
+        :param max_bytes: maximum bytes of fetched files kept on disk
+        :param consumers: number of results the consumer uses at once
+        """
+        super(Prefetcher, self).__init__()
+        self.fetch = fetch
+        self.items = items
+        self.get_filename = get_filename
+        self.ahead = max(ahead, 1)
+        self.max_bytes = max_bytes
+        self.filenames = []
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(self.ahead + max(consumers, 1))
+
+    def release(self):
+        """Mark a result as used, allowing another item to be fetched."""
+        self.slots.release()
+
+    def disk_usage(self):
+        """Returns the bytes used by fetched files not yet removed."""
+        usage = 0
+        with self.lock:
+            remaining = []
+            for filename in self.filenames:
+                try:
+                    usage += os.path.getsize(filename)
+                    remaining.append(filename)
+                except OSError:
+                    pass
+            self.filenames = remaining
+        return usage
+
+    def within_budget(self):
+        if self.max_bytes is None:
+            return True
+        # a single fetch is always allowed, even if it exceeds the budget
+        usage = self.disk_usage()
+        return usage == 0 or usage < self.max_bytes
+
+    def _track(self, future):
+        filename = self.get_filename(future.result())
+        if filename is not None:
+            with self.lock:
+                self.filenames.append(filename)
+
+    def __iter__(self):
+        items = iter(self.items)
+        pending = deque()
+        exhausted = False
+        with ThreadPoolExecutor(self.ahead) as executor:
+            while True:
+                while not exhausted and len(pending) < self.ahead:
+                    if not self.within_budget():
+                        if pending:
+                            break
+                        logging.debug("Prefetch budget exhausted, waiting")
+                        time.sleep(POLL_INTERVAL)
+                        continue
+                    # only wait for a result to be used if none is pending
+                    if not self.slots.acquire(blocking=not pending):
+                        break
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        self.slots.release()
+                        exhausted = True
+                        break
+                    future = executor.submit(self.fetch, item)
+                    future.add_done_callback(self._track)
+                    pending.append(future)
+
+                if not pending:
+                    break
+                yield pending.popleft().result()
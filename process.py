@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
-import datetime
 import json
 import logging
 import os
 import sys
 import zipfile
-from shutil import rmtree
+from functools import partial
+from multiprocessing import Pool
 from urllib.parse import urlparse
 
 import click
@@ -13,22 +13,21 @@ import requests
 
 import adapters
 import geoutils
+import instrumentation
+import manifest
 import utils
 from filters import BasicFilterer
+from filters import SpatialFilter
+from prefetch import Prefetcher
 
+# number of features streamed sources label at once
+LABEL_BATCH_SIZE = 1000
+# hidden directory of the output directory the versions of exploded
+# directories are kept in
+EXPLODED_STATE_DIR = ".exploded"
 
-@click.command()
-@click.argument("sources", type=click.Path(exists=True), required=True)
-@click.argument("output", type=click.Path(exists=True), required=True)
-@click.option("--force", is_flag=True)
-@click.option("--force-summary", is_flag=True)
-def process(sources, output, force, force_summary):
-    """Download sources and process the file to the output directory.
 
-    \b
-    SOURCES: Source JSON file or directory of files. Required.
-    OUTPUT: Destination directory for generated data. Required.
-    """
+def configure_logging():
     logging.basicConfig(
         level=logging.INFO,
         format="%(asctime)s [%(levelname)s] - %(message)s",
@@ -43,163 +42,388 @@ def process(sources, output, force, force_summary):
     requests.packages.urllib3.disable_warnings()
     # logging.getLogger('processing').setLevel(logging.DEBUG)
 
-    catalog_features = []
-    failures = []
-    path_parts_to_skip = utils.get_path_parts(sources).index("sources") + 1
-    success = True
-    for path in utils.get_files(sources):
+
+def get_output_pathparts(path, path_parts_to_skip):
+    """Returns the path parts of the generated GeoJSON file for a source,
+    relative to the output directory.
+
+    :param path: string, path to the source JSON file
+    :param path_parts_to_skip: int, leading path parts to drop from path
+    :returns: list of strings
+    """
+    pathparts = utils.get_path_parts(path)[path_parts_to_skip:]
+    pathparts[-1] = pathparts[-1].replace(".json", ".geojson")
+    return pathparts
+
+
+def get_output_dir(output, pathparts):
+    """Returns the directory the exploded GeoJSON of a source is written to.
+
+    :param output: string, destination directory for generated data
+    :param pathparts: list of strings returned by get_output_pathparts
+    :returns: string
+    """
+    return os.path.join(output, *pathparts[:-1], pathparts[-1].replace(".geojson", ""))
+
+
+def get_exploded_state_dir(output, pathparts):
+    """Returns the directory the versions of the exploded directory of a
+    source are kept in, see utils.ExplodedWriter.
+
+    :param output: string, destination directory for generated data
+    :param pathparts: list of strings returned by get_output_pathparts
+    :returns: string
+    """
+    return get_output_dir(os.path.join(output, EXPLODED_STATE_DIR), pathparts)
+
+
+def read_catalog_entry(outdir):
+    """Returns the catalog entry cached as source.json in the exploded
+    directory of a source, or None if the directory is incomplete.
+
+    :param outdir: string, exploded directory of the source
+    :returns: dict
+    """
+    if not os.path.exists(os.path.join(outdir, "units.json")):
+        return None
+    try:
+        return utils.read_json(os.path.join(outdir, "source.json"))
+    except (IOError, ValueError):
+        return None
+
+
+def get_source_properties(source):
+    """Returns the properties of the catalog entry of a source, taken from the
+    source JSON.
+
+    :param source: dict, source JSON
+    :returns: dict
+    """
+    excluded_keys = [
+        "filetype",
+        "url",
+        "properties",
+        "filter",
+        "spatialFilter",
+        "filenameInZip",
+    ]
+    properties = {k: v for k, v in list(source.items()) if k not in excluded_keys}
+    properties["source_url"] = source["url"]
+    return properties
+
+
+def remove_generated_files(outfile, pathparts):
+    """Remove the files previously generated next to outfile for a source.
+    The exploded directory is replaced by utils.ExplodedWriter and not removed.
+
+    :param outfile: string, path of the generated GeoJSON file
+    :param pathparts: list of strings returned by get_output_pathparts
+    """
+    filename_to_match, ext = os.path.splitext(pathparts[-1])
+    output_file_dir = os.sep.join(utils.get_path_parts(outfile)[:-1])
+    logging.info("looking for generated files to delete in " + output_file_dir)
+    for name in os.listdir(output_file_dir):
+        base, ext = os.path.splitext(name)
+        if base == filename_to_match and os.path.isfile(
+            os.path.join(output_file_dir, name)
+        ):
+            to_remove = os.path.join(output_file_dir, name)
+            logging.info("Removing generated file " + to_remove)
+            os.remove(to_remove)
+
+
+def _new_result(path):
+    return {
+        "path": path,
+        "catalog_entry": None,
+        "manifest_entry": None,
+        "failed": False,
+        "error": False,
+        "stats": None,
+    }
+
+
+def fetch_source(
+    path, output, path_parts_to_skip, manifest_entry=None, force=False, options=None
+):
+    """Read a source and download its data, unless the generated output is
+    up to date.
+
+    :param path: string, path to the source JSON file
+    :param output: string, destination directory for generated data
+    :param path_parts_to_skip: int, leading path parts to drop from path
+    :param manifest_entry: dict, build manifest entry from the previous run
+    :param options: dict returned by manifest.get_options
+    :returns: dict describing the fetched source, to be passed to build_source
+    """
+    result = _new_result(path)
+    fetched = {
+        "path": path,
+        "source": None,
+        "previous_manifest_entry": manifest_entry,
+        "read_existing": False,
+        "filename": None,
+        "result": result,
+        "stats": instrumentation.SourceStats(path),
+    }
+    stats = fetched["stats"]
+    try:
+        pathparts = get_output_pathparts(path, path_parts_to_skip)
+        fetched["pathparts"] = pathparts
+        outfile = os.path.join(output, *pathparts)
+
+        source = utils.read_json(path)
+        fetched["source"] = source
+
+        if not hasattr(adapters, source["filetype"]):
+            logging.error("Unknown filetype " + source["filetype"])
+            result["failed"] = True
+            return fetched
+
+        # output is reused only if the source JSON, the code, the options and
+        # the upstream data are all unchanged since the manifest entry was
+        # written
+        with stats.stage("check"):
+            source_hash = manifest.hash_file(path)
+        maybe_up_to_date = False
+        if os.path.isfile(outfile):
+            if force:
+                logging.info("Regenerating " + outfile + " since --force is set")
+            elif not manifest.source_unchanged(manifest_entry, source_hash, options):
+                logging.info(
+                    "Output is outdated, source, code or options changed: " + path
+                )
+            else:
+                # only worth asking the server if they can skip the build
+                with stats.stage("check"):
+                    validators = utils.get_validators(source["url"])
+                if manifest.validators_unchanged(manifest_entry, validators):
+                    logging.info("Upstream validators are unchanged: " + path)
+                    fetched["read_existing"] = True
+                    return fetched
+                maybe_up_to_date = True
+
+        logging.info("Downloading " + source["url"])
         try:
-            logging.info("Processing " + path)
-            pathparts = utils.get_path_parts(path)[path_parts_to_skip:]
-            pathparts[-1] = pathparts[-1].replace(".json", ".geojson")
+            with stats.stage("download") as counts:
+                fp = utils.download(source["url"])
+                counts["bytes"] = os.path.getsize(fp.name)
+        except IOError:
+            logging.error("Failed to download " + source["url"])
+            result["failed"] = True
+            return fetched
+
+        with stats.stage("check"):
+            download_hash = manifest.hash_file(fp.name)
+        result["manifest_entry"] = manifest.make_entry(
+            source_hash, download_hash, fp.validators, options
+        )
+        if maybe_up_to_date and manifest.download_unchanged(
+            manifest_entry, download_hash
+        ):
+            logging.info("Downloaded data is unchanged: " + path)
+            os.remove(fp.name)
+            fetched["read_existing"] = True
+        else:
+            fetched["filename"] = fp.name
+    except Exception as e:
+        logging.error(str(e))
+        logging.exception("Error fetching file " + path)
+        result["failed"] = True
+        result["error"] = True
+
+    return fetched
+
+
+def build_source(
+    fetched,
+    output,
+    force_summary=False,
+    stream=False,
+    compress=None,
+    geometry_jobs=1,
+    columnar=False,
+):
+    """Process a fetched source to the output directory.
 
-            outdir = os.path.join(
-                output, *pathparts[:-1], pathparts[-1].replace(".geojson", "")
+    :param fetched: dict returned by fetch_source
+    :param output: string, destination directory for generated data
+    :param stream: bool, process the source with stream_source
+    :param compress: list of codecs to also write compressed copies of the
+        generated GeoJSON with
+    :param geometry_jobs: int, number of processes to merge, union the
+        geometry of the source and generate label points in
+    :param columnar: bool, hold the features of the source in a
+        columnar.FeatureStore, not used with stream
+    :returns: dict with the catalog entry and manifest entry for the source,
+        if any, and whether the source failed or errored
+    """
+    path = fetched["path"]
+    source = fetched["source"]
+    read_existing = fetched["read_existing"]
+    result = fetched["result"]
+    stats = fetched["stats"]
+    result["stats"] = stats.to_dict()
+    if result["failed"]:
+        result["manifest_entry"] = None
+        return result
+
+    try:
+        logging.info("Processing " + path)
+        pathparts = fetched["pathparts"]
+
+        outdir = get_output_dir(output, pathparts)
+        outfile = os.path.join(output, *pathparts)
+        urlfile = urlparse(source["url"]).path.split("/")[-1]
+        union = None
+
+        if read_existing:
+            logging.warning(
+                "Skipping "
+                + path
+                + " since generated file is up to date. Use --force to regenerate."
             )
-            outfile = os.path.join(output, *pathparts)
-
-            source = utils.read_json(path)
-            urlfile = urlparse(source["url"]).path.split("/")[-1]
-
-            if not hasattr(adapters, source["filetype"]):
-                logging.error("Unknown filetype " + source["filetype"])
-                failures.append(path)
-                continue
-
-            read_existing = False
-            if os.path.isfile(outfile):
-                logging.info("Output file exists")
-                if os.path.getmtime(outfile) > os.path.getmtime(path):
-                    logging.info("Output file is up to date")
-                    if not force:
-                        read_existing = True
-                        logging.warning(
-                            "Skipping "
-                            + path
-                            + " since generated file exists. Use --force to regenerate."
-                        )
-                else:
-                    logging.info(
-                        "Output is outdated, {} < {}".format(
-                            datetime.datetime.fromtimestamp(os.path.getmtime(outfile)),
-                            datetime.datetime.fromtimestamp(os.path.getmtime(path)),
-                        )
-                    )
+            if result["manifest_entry"] is None:
+                result["manifest_entry"] = fetched["previous_manifest_entry"]
 
-            if read_existing:
-                with open(outfile, "rb") as f:
-                    geojson = json.load(f)
-                properties = geojson["properties"]
-            else:
-                logging.info("Downloading " + source["url"])
+            # the union, bbox and demo point were computed when the output
+            # was generated, there is no need to read it again
+            if not force_summary:
+                result["catalog_entry"] = read_catalog_entry(outdir)
+                if result["catalog_entry"] is not None:
+                    logging.info("Using cached catalog entry for " + path)
+                    return result
 
-                try:
-                    fp = utils.download(source["url"])
-                except IOError:
-                    logging.error("Failed to download " + source["url"])
-                    failures.append(path)
-                    continue
+            with stats.stage("load") as counts, open(outfile, "rb") as f:
+                geojson = json.load(f)
+                counts["features"] = len(geojson["features"])
+            properties = geojson["properties"]
+        else:
+            logging.info("Reading " + urlfile)
 
-                logging.info("Reading " + urlfile)
+            if "filter" in source:
+                filterer = BasicFilterer(
+                    source["filter"], source.get("filterOperator", "and")
+                )
+            else:
+                filterer = None
+            if "spatialFilter" in source:
+                spatial_filter = SpatialFilter(source["spatialFilter"])
+            else:
+                spatial_filter = None
 
-                if "filter" in source:
-                    filterer = BasicFilterer(
-                        source["filter"], source.get("filterOperator", "and")
+            try:
+                if stream:
+                    result["catalog_entry"] = stream_source(
+                        fetched,
+                        output,
+                        filterer,
+                        compress=compress,
+                        geometry_jobs=geometry_jobs,
+                        spatial_filter=spatial_filter,
                     )
                 else:
-                    filterer = None
-
-                try:
-                    geojson = getattr(adapters, source["filetype"]).read(
-                        fp,
-                        source["properties"],
-                        filterer=filterer,
-                        layer_name=source.get("layerName", None),
-                        source_filename=source.get("filenameInZip", None),
-                        merge_on=source.get("mergeOn", None),
-                    )
-                except IOError as e:
-                    logging.error("Failed to read " + urlfile + " " + str(e))
-                    failures.append(path)
-                    continue
-                except zipfile.BadZipfile as e:
-                    logging.error("Unable to open zip file " + source["url"])
-                    failures.append(path)
-                    continue
-                finally:
-                    os.remove(fp.name)
-
-                if (len(geojson["features"])) == 0:
+                    with stats.stage("read") as counts, open(
+                        fetched["filename"], "rb"
+                    ) as fp:
+                        geojson = getattr(adapters, source["filetype"]).read(
+                            fp,
+                            source["properties"],
+                            filterer=filterer,
+                            layer_name=source.get("layerName", None),
+                            source_filename=source.get("filenameInZip", None),
+                            merge_on=source.get("mergeOn", None),
+                            stats=stats,
+                            columnar=columnar,
+                            processes=geometry_jobs,
+                            merge_adjacent_only=source.get("mergeAdjacentOnly", False),
+                            spatial_filter=spatial_filter,
+                        )
+                        counts["features"] = len(geojson["features"])
+            except IOError as e:
+                logging.error("Failed to read " + urlfile + " " + str(e))
+                result["failed"] = True
+                return result
+            except zipfile.BadZipfile as e:
+                logging.error("Unable to open zip file " + source["url"])
+                result["failed"] = True
+                return result
+
+            if stream:
+                if result["catalog_entry"] is None:
                     logging.error("Result contained no features for " + path)
-                    continue
-
-                # generate properties
-                excluded_keys = [
-                    "filetype",
-                    "url",
-                    "properties",
-                    "filter",
-                    "filenameInZip",
-                ]
-                properties = {
-                    k: v for k, v in list(source.items()) if k not in excluded_keys
-                }
-                properties["source_url"] = source["url"]
-                properties["feature_count"] = len(geojson["features"])
-                properties["demo"] = geoutils.get_demo_point(geojson)
-                geojson["properties"] = properties
-                if "bbox" not in geojson:
-                    geojson["bbox"] = geoutils.get_bbox_from_geojson(geojson)
-
-                utils.make_sure_path_exists(os.path.dirname(outfile))
-
-                # cleanup existing generated files
-                if os.path.exists(outdir):
-                    rmtree(outdir)
-                filename_to_match, ext = os.path.splitext(pathparts[-1])
-                output_file_dir = os.sep.join(utils.get_path_parts(outfile)[:-1])
-                logging.info(
-                    "looking for generated files to delete in " + output_file_dir
+                else:
+                    logging.info("Done. Processed to " + outfile)
+                return result
+
+            if (len(geojson["features"])) == 0:
+                logging.error("Result contained no features for " + path)
+                return result
+
+            # generate properties
+            properties = get_source_properties(source)
+            properties["feature_count"] = len(geojson["features"])
+            with stats.stage("union"):
+                union = geoutils.get_union(geojson, processes=geometry_jobs)
+            with stats.stage("demo_point"):
+                properties["demo"] = geoutils.get_demo_point(
+                    geojson, envelope=geoutils.get_bbox_from_geojson_geometry(union)
                 )
-                for name in os.listdir(output_file_dir):
-                    base, ext = os.path.splitext(name)
-                    if base == filename_to_match:
-                        to_remove = os.path.join(output_file_dir, name)
-                        logging.info("Removing generated file " + to_remove)
-                        os.remove(to_remove)
+            geojson["properties"] = properties
+            if "bbox" not in geojson:
+                geojson["bbox"] = geoutils.get_bbox_from_geojson(geojson)
+
+            utils.make_sure_path_exists(os.path.dirname(outfile))
 
-                utils.write_json(outfile, geojson)
+            # cleanup existing generated files
+            remove_generated_files(outfile, pathparts)
 
-                logging.info("Generating label points")
-                label_geojson = geoutils.get_label_points(geojson)
+            with stats.stage("write") as counts:
+                utils.write_json(outfile, geojson, compress=compress)
+                counts["features"] = len(geojson["features"])
+
+            logging.info("Generating label points")
+            with stats.stage("labels") as counts:
+                label_geojson = geoutils.get_label_points(
+                    geojson, processes=geometry_jobs
+                )
                 label_path = outfile.replace(".geojson", ".labels.geojson")
-                utils.write_json(label_path, label_geojson)
-
-                logging.info("Done. Processed to " + outfile)
-
-            if not "demo" in properties:
-                properties["demo"] = geoutils.get_demo_point(geojson)
-
-            properties["path"] = "/".join(pathparts)
-            catalog_entry = {
-                "type": "Feature",
-                "properties": properties,
-                "geometry": geoutils.get_union(geojson),
-                "bbox": geoutils.get_bbox_from_geojson(geojson),
-            }
-            catalog_features.append(catalog_entry)
-
-            if (
-                force_summary
-                or not read_existing
-                or not os.path.exists(outdir)
-                or not os.path.exists(os.path.join(outdir, "units.json"))
-                or not os.path.exists(os.path.join(outdir, "source.json"))
-            ):
-                logging.info("Generated exploded GeoJSON to " + outdir)
-                if not os.path.exists(outdir):
-                    os.makedirs(outdir)
-                units = []
+                utils.write_json(label_path, label_geojson, compress=compress)
+                counts["features"] = len(label_geojson["features"])
+
+            logging.info("Done. Processed to " + outfile)
+
+        if union is None:
+            with stats.stage("union"):
+                union = geoutils.get_union(geojson, processes=geometry_jobs)
+
+        if not "demo" in properties:
+            with stats.stage("demo_point"):
+                properties["demo"] = geoutils.get_demo_point(
+                    geojson, envelope=geoutils.get_bbox_from_geojson_geometry(union)
+                )
+
+        properties["path"] = "/".join(pathparts)
+        catalog_entry = {
+            "type": "Feature",
+            "properties": properties,
+            "geometry": union,
+            "bbox": geojson.get("bbox") or geoutils.get_bbox_from_geojson(geojson),
+        }
+        result["catalog_entry"] = catalog_entry
+
+        if (
+            force_summary
+            or not read_existing
+            or not os.path.exists(outdir)
+            or not os.path.exists(os.path.join(outdir, "units.json"))
+            or not os.path.exists(os.path.join(outdir, "source.json"))
+        ):
+            logging.info("Generating exploded GeoJSON to " + outdir)
+            units = []
+            with stats.stage("exploded") as counts, utils.ExplodedWriter(
+                outdir, get_exploded_state_dir(output, pathparts)
+            ) as exploded:
                 for feature in geojson["features"]:
                     if not "bbox" in feature:
                         feature["bbox"] = geoutils.get_bbox_from_geojson_geometry(
@@ -207,25 +431,454 @@ def process(sources, output, force, force_summary):
                         )
                     feature_id = str(feature["properties"]["id"])
                     feature_id = feature_id.replace("/", "")
-                    feature_filename = os.path.join(outdir, feature_id + ".geojson")
-                    utils.write_json(feature_filename, feature)
+                    exploded.write(feature_id + ".geojson", feature)
                     units.append(feature["properties"])
                 # source.json is just the catalog entry
                 # units.json is the properties dicts from all of the units in an array
                 # .json instead of .geojson, incase there is a unit named "source"
-                utils.write_json(os.path.join(outdir, "source.json"), catalog_entry)
-                utils.write_json(os.path.join(outdir, "units.json"), units)
-            else:
-                logging.debug("exploded GeoJSON already exists, not generating")
+                exploded.write("source.json", catalog_entry)
+                exploded.write("units.json", units)
+                counts["features"] = len(units)
+        else:
+            logging.debug("exploded GeoJSON already exists, not generating")
+
+    except Exception as e:
+        logging.error(str(e))
+        logging.exception("Error processing file " + path)
+        result["failed"] = True
+        result["error"] = True
+    finally:
+        # the download is no longer needed, this also frees prefetch budget
+        if fetched["filename"] is not None and os.path.exists(fetched["filename"]):
+            os.remove(fetched["filename"])
+        result["stats"] = stats.to_dict()
+
+    if result["failed"]:
+        result["manifest_entry"] = None
+    return result
+
+
+def stream_source(
+    fetched, output, filterer, compress=None, geometry_jobs=1, spatial_filter=None
+):
+    """Process a fetched source to the output directory one feature at a time.
+
+    Each feature is written to the generated GeoJSON, labels and exploded
+    files as it is read. Only the inputs of the union, the ring bounding boxes
+    and the unit properties are kept in memory. The demo point is chosen from
+    the ring bounding boxes instead of the rings.
+
+    :param fetched: dict returned by fetch_source
+    :param output: string, destination directory for generated data
+    :param filterer: BasicFilterer or None
+    :param compress: list of codecs to also write compressed copies of the
+        generated GeoJSON with
+    :param geometry_jobs: int, number of processes to merge, union the
+        geometry of the source and generate label points in
+    :param spatial_filter: SpatialFilter or None
+    :returns: dict, the catalog entry of the source, or None if the source
+        has no features
+    """
+    source = fetched["source"]
+    stats = fetched["stats"]
+    pathparts = fetched["pathparts"]
+    outdir = get_output_dir(output, pathparts)
+    outfile = os.path.join(output, *pathparts)
+    utils.make_sure_path_exists(os.path.dirname(outfile))
+
+    polylabel = geoutils.get_polylabel()
+    label_pool = None
+    if polylabel and geometry_jobs > 1:
+        label_pool = Pool(geometry_jobs)
+    unlabeled = []
+    union_parts = []
+    ring_bounds = []
+    units = []
+    bbox = None
+
+    geojson = utils.FeatureCollectionWriter(outfile, compress=compress)
+    labels = utils.FeatureCollectionWriter(
+        outfile.replace(".geojson", ".labels.geojson"), compress=compress
+    )
+    exploded = utils.ExplodedWriter(outdir, get_exploded_state_dir(output, pathparts))
+    writers = [geojson, labels, exploded]
+    try:
+        with stats.stage("stream") as counts, open(fetched["filename"], "rb") as fp:
+            features = getattr(adapters, source["filetype"]).stream(
+                fp,
+                source["properties"],
+                filterer=filterer,
+                layer_name=source.get("layerName", None),
+                source_filename=source.get("filenameInZip", None),
+                merge_on=source.get("mergeOn", None),
+                stats=stats,
+                processes=geometry_jobs,
+                merge_adjacent_only=source.get("mergeAdjacentOnly", False),
+                spatial_filter=spatial_filter,
+            )
+            for feature in features:
+                geojson.write(feature)
+                unlabeled.append(feature)
+                if len(unlabeled) == LABEL_BATCH_SIZE:
+                    write_label_points(labels, unlabeled, polylabel, label_pool)
+                    unlabeled = []
+
+                union_parts.extend(geoutils.get_union_part(feature))
+                for ring in geoutils.get_feature_rings(feature):
+                    ring_bounds.append(
+                        geoutils.get_bbox_from_geojson_geometry({"coordinates": ring})
+                    )
+                feature_bbox = feature["bbox"]
+                if bbox is None:
+                    bbox = feature_bbox
+                else:
+                    bbox = (
+                        min(bbox[0], feature_bbox[0]),
+                        min(bbox[1], feature_bbox[1]),
+                        max(bbox[2], feature_bbox[2]),
+                        max(bbox[3], feature_bbox[3]),
+                    )
+
+                feature_id = str(feature["properties"]["id"])
+                feature_id = feature_id.replace("/", "")
+                exploded.write(feature_id + ".geojson", feature)
+                units.append(feature["properties"])
+            write_label_points(labels, unlabeled, polylabel, label_pool)
+            counts["features"] = len(units)
+
+        if len(units) == 0:
+            for writer in writers:
+                writer.abort()
+            return None
+
+        with stats.stage("union"):
+            union = geoutils.union_shapes(union_parts, processes=geometry_jobs)
+        with stats.stage("demo_point"):
+            demo = geoutils.get_demo_point_for_rings(
+                ring_bounds, geoutils.get_bbox_from_geojson_geometry(union)
+            )
+
+        properties = get_source_properties(source)
+        properties["feature_count"] = len(units)
+        properties["demo"] = demo
+
+        remove_generated_files(outfile, pathparts)
+        with stats.stage("write"):
+            geojson.close({"bbox": bbox, "properties": properties})
+            labels.close()
+
+        properties["path"] = "/".join(pathparts)
+        catalog_entry = {
+            "type": "Feature",
+            "properties": properties,
+            "geometry": union,
+            "bbox": bbox,
+        }
+        with stats.stage("exploded") as counts:
+            exploded.write("source.json", catalog_entry)
+            exploded.write("units.json", units)
+            exploded.close()
+            counts["features"] = len(units)
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+    finally:
+        if label_pool is not None:
+            label_pool.close()
+            label_pool.join()
+
+    return catalog_entry
+
+
+def write_label_points(writer, features, polylabel, pool=None):
+    """Write the label points of features.
+
+    :param writer: utils.FeatureCollectionWriter
+    :param features: list of GeoJSON features
+    :param polylabel: function returned by geoutils.get_polylabel, or None
+    :param pool: multiprocessing Pool to run polylabel in, or None
+    """
+    for label in geoutils.get_features_label_points(features, polylabel, pool=pool):
+        writer.write(label)
+
+
+def process_source(
+    path,
+    output,
+    path_parts_to_skip,
+    manifest_entry=None,
+    force=False,
+    force_summary=False,
+    stream=False,
+    compress=None,
+    geometry_jobs=1,
+    columnar=False,
+    options=None,
+):
+    """Download a single source and process it to the output directory.
+
+    :param path: string, path to the source JSON file
+    :param output: string, destination directory for generated data
+    :param path_parts_to_skip: int, leading path parts to drop from path
+    :param manifest_entry: dict, build manifest entry from the previous run
+    :param options: dict returned by manifest.get_options
+    :returns: dict with the catalog entry and manifest entry for the source,
+        if any, and whether the source failed or errored
+    """
+    fetched = fetch_source(
+        path,
+        output,
+        path_parts_to_skip,
+        manifest_entry=manifest_entry,
+        force=force,
+        options=options,
+    )
+    return build_source(
+        fetched,
+        output,
+        force_summary=force_summary,
+        stream=stream,
+        compress=compress,
+        geometry_jobs=geometry_jobs,
+        columnar=columnar,
+    )
+
 
-        except Exception as e:
-            logging.error(str(e))
-            logging.exception("Error processing file " + path)
-            failures.append(path)
+def load_source(path, output, path_parts_to_skip):
+    """Read the cached catalog entry of a source, without downloading or
+    processing it.
+
+    :param path: string, path to the source JSON file
+    :param output: string, destination directory for generated data
+    :param path_parts_to_skip: int, leading path parts to drop from path
+    :returns: dict with the catalog entry for the source and whether the
+        source failed
+    """
+    result = _new_result(path)
+    pathparts = get_output_pathparts(path, path_parts_to_skip)
+    stats = instrumentation.SourceStats(path)
+    with stats.stage("load"):
+        result["catalog_entry"] = read_catalog_entry(get_output_dir(output, pathparts))
+    result["stats"] = stats.to_dict()
+    if result["catalog_entry"] is None:
+        logging.error("No cached catalog entry for " + path)
+        result["failed"] = True
+    return result
+
+
+def _process_task(task, **kwargs):
+    path, manifest_entry = task
+    return process_source(path, manifest_entry=manifest_entry, **kwargs)
+
+
+def _fetch_task(task, **kwargs):
+    path, manifest_entry = task
+    return fetch_source(path, manifest_entry=manifest_entry, **kwargs)
+
+
+def _get_fetched_filename(fetched):
+    return fetched["filename"]
+
+
+@click.command()
+@click.argument("sources", type=click.Path(exists=True), required=True)
+@click.argument("output", type=click.Path(exists=True), required=True)
+@click.option("--force", is_flag=True)
+@click.option("--force-summary", is_flag=True)
+@click.option(
+    "--jobs", "-j", default=1, help="Number of sources to process in parallel"
+)
+@click.option(
+    "--prefetch",
+    default=0,
+    help="Number of downloaded sources kept waiting for processing, 0 to disable",
+)
+@click.option(
+    "--prefetch-max-mb",
+    default=2048,
+    help="Maximum size of prefetched downloads kept on disk, in MB",
+)
+@click.option(
+    "--catalog-only",
+    is_flag=True,
+    help="Only rebuild catalog.geojson from the cached catalog entries",
+)
+@click.option(
+    "--report",
+    type=click.Path(),
+    help="Write a JSON report of time and resources used per source and stage",
+)
+@click.option(
+    "--stream",
+    is_flag=True,
+    help="Process sources one feature at a time, for sources larger than memory",
+)
+@click.option(
+    "--compress",
+    multiple=True,
+    type=click.Choice(sorted(utils.COMPRESSION_EXTENSIONS)),
+    help="Also write copies of the generated GeoJSON compressed with a codec, "
+    "can be repeated",
+)
+@click.option(
+    "--geometry-jobs",
+    default=1,
+    help="Number of processes to merge, union the geometry of a large source "
+    "and generate its label points in, only used with --jobs 1",
+)
+@click.option(
+    "--columnar",
+    is_flag=True,
+    help="Hold the features of a source in flat arrays instead of GeoJSON "
+    "objects while processing it, not used with --stream",
+)
+def process(
+    sources,
+    output,
+    force,
+    force_summary,
+    jobs,
+    prefetch,
+    prefetch_max_mb,
+    catalog_only,
+    report,
+    stream,
+    compress,
+    geometry_jobs,
+    columnar,
+):
+    """Download sources and process the file to the output directory.
+
+    \b
+    SOURCES: Source JSON file or directory of files. Required.
+    OUTPUT: Destination directory for generated data. Required.
+    """
+    configure_logging()
+
+    compress = list(compress)
+    for codec in compress:
+        if codec not in utils.get_compression_codecs():
+            raise click.BadParameter(
+                "%s is not available, is its module installed?" % codec,
+                param_hint="--compress",
+            )
+
+    # pool workers are daemonic and cannot start pools of their own
+    if jobs > 1 and geometry_jobs > 1:
+        logging.warning("Ignoring --geometry-jobs since sources run in parallel")
+        geometry_jobs = 1
+
+    failures = []
+    path_parts_to_skip = utils.get_path_parts(sources).index("sources") + 1
+    success = True
+
+    manifest_entries = manifest.read_manifest(output)
+    options = manifest.get_options(
+        stream=stream, compress=compress, geometry_jobs=geometry_jobs
+    )
+    prefetcher = None
+    tasks = []
+    for path in utils.get_files(sources):
+        key = "/".join(get_output_pathparts(path, path_parts_to_skip))
+        tasks.append((path, manifest_entries.get(key)))
+
+    if catalog_only:
+        tasks = [path for path, manifest_entry in tasks]
+        func = partial(
+            load_source, output=output, path_parts_to_skip=path_parts_to_skip
+        )
+    elif prefetch > 0:
+        # downloads run in threads ahead of processing, which then only
+        # needs to build the fetched sources
+        prefetcher = Prefetcher(
+            partial(
+                _fetch_task,
+                output=output,
+                path_parts_to_skip=path_parts_to_skip,
+                force=force,
+                options=options,
+            ),
+            tasks,
+            _get_fetched_filename,
+            ahead=prefetch,
+            max_bytes=prefetch_max_mb * 1024 * 1024,
+            consumers=jobs,
+        )
+        tasks = prefetcher
+        func = partial(
+            build_source,
+            output=output,
+            force_summary=force_summary,
+            stream=stream,
+            compress=compress,
+            geometry_jobs=geometry_jobs,
+            columnar=columnar,
+        )
+    else:
+        func = partial(
+            _process_task,
+            output=output,
+            path_parts_to_skip=path_parts_to_skip,
+            force=force,
+            force_summary=force_summary,
+            stream=stream,
+            compress=compress,
+            geometry_jobs=geometry_jobs,
+            columnar=columnar,
+            options=options,
+        )
+
+    if jobs > 1 and not catalog_only:
+        pool = Pool(jobs, initializer=configure_logging)
+        results = pool.imap(func, tasks, chunksize=1)
+    else:
+        pool = None
+        results = map(func, tasks)
+
+    # catalog entries are written as they arrive, imap yields results in
+    # submission order so the catalog is identical to a serial run's
+    catalog = utils.FeatureCollectionWriter(
+        os.path.join(output, "catalog.geojson"), compress=compress
+    )
+    manifest_writer = None
+    if not catalog_only:
+        manifest_writer = manifest.ManifestWriter(output, manifest_entries)
+    source_stats = []
+    for result in results:
+        if prefetcher is not None:
+            prefetcher.release()
+        if result["stats"] is not None:
+            source_stats.append(result["stats"])
+        if result["catalog_entry"] is not None:
+            catalog.write(result["catalog_entry"])
+            catalog.flush()
+        if result["failed"]:
+            failures.append(result["path"])
+        if result["error"] or (catalog_only and result["failed"]):
             success = False
 
-    catalog = {"type": "FeatureCollection", "features": catalog_features}
-    utils.write_json(os.path.join(output, "catalog.geojson"), catalog)
+        if catalog_only:
+            continue
+        key = "/".join(get_output_pathparts(result["path"], path_parts_to_skip))
+        if result["manifest_entry"] is not None:
+            manifest_writer.set(key, result["manifest_entry"])
+        elif result["failed"]:
+            manifest_writer.remove(key)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    catalog.close()
+    if manifest_writer is not None:
+        manifest_writer.close()
+
+    if report:
+        run_report = instrumentation.get_report(source_stats)
+        with open(report, "w") as f:
+            json.dump(run_report, f, indent=2)
+        instrumentation.log_summary(run_report)
 
     if not success:
         logging.error("Failed sources: " + ", ".join(failures))
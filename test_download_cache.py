@@ -0,0 +1,64 @@
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+import download_cache
+from download_cache import DownloadCache
+
+
+class DownloadCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = DownloadCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def age(self, path, seconds):
+        mtime = time.time() - seconds
+        os.utime(path, (mtime, mtime))
+
+    def download(self, content):
+        fp = self.cache.create_download_file(suffix=".zip")
+        fp.write(content)
+        fp.close()
+        return fp.name
+
+    def test_old_checkout_survives_new_cache(self):
+        url = "http://example.com/data.zip"
+        self.cache.put(url, self.download(b"data"))
+        entry = self.cache.get(url)
+        self.age(entry["path"], 2 * download_cache.TMP_MAX_AGE)
+
+        checked_out = self.download(b"")
+        self.assertTrue(self.cache.checkout(entry, checked_out))
+        DownloadCache(self.path)
+        # as if opened by another process, which sweeps the directory again
+        download_cache._swept_tmp_paths.clear()
+        DownloadCache(self.path)
+
+        with open(checked_out, "rb") as f:
+            self.assertEqual(f.read(), b"data")
+
+    def test_abandoned_staging_file_is_removed(self):
+        staged = os.path.join(self.cache.tmp_path, download_cache.STAGING_PREFIX + "x")
+        open(staged, "wb").close()
+        self.age(staged, 2 * download_cache.TMP_MAX_AGE)
+
+        download_cache._swept_tmp_paths.clear()
+        DownloadCache(self.path)
+
+        self.assertFalse(os.path.exists(staged))
+
+    def test_put_leaves_file_writable(self):
+        filename = self.download(b"data")
+        self.cache.put("http://example.com/data.zip", filename)
+
+        self.assertTrue(os.stat(filename).st_mode & stat.S_IWUSR)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,30 +5,59 @@ import shutil
 import sys
 import tarfile
 import tempfile
+import threading
+import uuid
 import urllib.error
 import urllib.parse
 import urllib.request
 import zipfile
+import zlib
 from contextlib import closing
+from multiprocessing.pool import ThreadPool
 from urllib.parse import urlparse
 
-import boto3
 import click
 import requests
 import ujson
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import BotoCoreError
+from botocore.exceptions import ClientError
 
-CHUNK_SIZE = 1024
+from download_cache import get_download_cache
+from download_cache import get_s3_cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CHUNK_SIZE = 1024 * 1024
+VALIDATOR_HEADERS = ["ETag", "Last-Modified"]
+# request headers that make a GET conditional on each validator
+CONDITIONAL_HEADERS = {"ETag": "If-None-Match", "Last-Modified": "If-Modified-Since"}
+POOL_MAXSIZE = 10
+# seconds to wait for the server when requesting the validators of a url
+VALIDATOR_TIMEOUT = 30
+# size of the chunks generated files are written in
+WRITE_CHUNK_SIZE = 1024 * 1024
+# file extensions of compressed copies of generated files, by codec
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "brotli": ".br"}
+
+_sessions = {}
 
 
 def get_files(path):
     """Returns an iterable containing the full path of all files in the
-    specified path.
+    specified path. Hidden files and directories are skipped, and links to
+    directories are followed.
 
     :param path: string
     :yields: string
     """
     if os.path.isdir(path):
-        for (dirpath, dirnames, filenames) in os.walk(path):
+        for (dirpath, dirnames, filenames) in os.walk(path, followlinks=True):
+            # hidden directories hold state that is not published
+            dirnames[:] = [d for d in dirnames if not d[0] == "."]
             for filename in filenames:
                 if not filename[0] == ".":
                     yield os.path.join(dirpath, filename)
@@ -46,11 +75,379 @@ def read_json(path):
         return ujson.loads(jsonfile.read())
 
 
-def write_json(path, data):
-    with open(path, "w") as jsonfile:
-        jsonfile.write(
-            ujson.dumps(data, escape_forward_slashes=False, double_precision=5)
+def dump_json(data):
+    """Returns data serialized as compact JSON, the way it is written to
+    generated files.
+
+    :param data: object
+    :returns: string
+    """
+    return ujson.dumps(data, escape_forward_slashes=False, double_precision=5)
+
+
+def write_json(path, data, compress=None):
+    """Write data as JSON. The features of a FeatureCollection are serialized
+    one at a time, so the whole document is never held in memory as a string.
+    They can be a list, or any object with a get_feature method iterating over
+    them as a columnar.FeatureStore does.
+
+    :param path: string
+    :param data: object
+    :param compress: list of codecs in COMPRESSION_EXTENSIONS to also write
+        compressed copies with
+    """
+    with OutputFile(path, compress) as f:
+        if isinstance(data, dict) and (
+            isinstance(data.get("features"), list)
+            or hasattr(data.get("features"), "get_feature")
+        ):
+            f.write("{")
+            for i, (key, value) in enumerate(data.items()):
+                if i > 0:
+                    f.write(",")
+                f.write(dump_json(key) + ":")
+                if key == "features":
+                    f.write("[")
+                    for j, feature in enumerate(value):
+                        if j > 0:
+                            f.write(",")
+                        f.write(dump_json(feature))
+                    f.write("]")
+                else:
+                    f.write(dump_json(value))
+            f.write("}")
+        else:
+            f.write(dump_json(data))
+
+
+def get_compression_codecs():
+    """Returns the codecs compressed copies of generated files can be written
+    with. brotli is only available if the brotli module is installed.
+
+    :returns: list of strings
+    """
+    return [c for c in COMPRESSION_EXTENSIONS if c != "brotli" or brotli is not None]
+
+
+def _get_compressor(codec):
+    """Returns the compress and finish functions of a new compressor."""
+    if codec == "gzip":
+        # gzip container with no file name and a zero mtime, so the same
+        # content always compresses to the same bytes
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+        return compressor.compress, compressor.flush
+    elif codec == "brotli":
+        compressor = brotli.Compressor()
+        return compressor.process, compressor.finish
+    raise ValueError("Unknown compression codec " + codec)
+
+
+class OutputFile(object):
+    """Text file written through a buffer of bounded size, with compressed
+    copies of it written in the same pass.
+
+    The file and its compressed copies are written to temporary files and
+    moved into place when closed. Compressed copies left by a previous run
+    with other codecs are removed then.
+    """
+
+    def __init__(self, path, compress=None):
+        """
+        :param path: string
+        :param compress: list of codecs in COMPRESSION_EXTENSIONS
+        """
+        super(OutputFile, self).__init__()
+        self.path = path
+        self.compress = list(compress or [])
+        self.buffer = []
+        self.buffered = 0
+        self.closed = False
+
+        # (path, temporary file, compress function, finish function)
+        self.sinks = [(path, open(path + ".tmp", "wb"), None, None)]
+        for codec in self.compress:
+            compressed_path = path + COMPRESSION_EXTENSIONS[codec]
+            compress_data, finish = _get_compressor(codec)
+            f = open(compressed_path + ".tmp", "wb")
+            self.sinks.append((compressed_path, f, compress_data, finish))
+
+    def write(self, data):
+        """Append a string to the file.
+
+        :param data: string
+        """
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= WRITE_CHUNK_SIZE:
+            self._write_buffer()
+
+    def _write_buffer(self):
+        chunk = "".join(self.buffer).encode()
+        self.buffer = []
+        self.buffered = 0
+        for path, f, compress_data, finish in self.sinks:
+            f.write(chunk if compress_data is None else compress_data(chunk))
+
+    def flush(self):
+        """Write buffered data to the uncompressed file."""
+        self._write_buffer()
+        self.sinks[0][1].flush()
+
+    def close(self):
+        """Finish the file and its compressed copies and move them into place."""
+        self._write_buffer()
+        for path, f, compress_data, finish in self.sinks:
+            if finish is not None:
+                f.write(finish())
+            f.close()
+        for path, f, compress_data, finish in self.sinks:
+            os.replace(path + ".tmp", path)
+        for codec, extension in COMPRESSION_EXTENSIONS.items():
+            if codec not in self.compress and os.path.exists(self.path + extension):
+                os.remove(self.path + extension)
+        self.closed = True
+
+    def abort(self):
+        """Discard the file, leaving the destination untouched. Does nothing if
+        the file was already closed."""
+        if self.closed:
+            return
+        for path, f, compress_data, finish in self.sinks:
+            f.close()
+            os.remove(path + ".tmp")
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class FeatureCollectionWriter(object):
+    """Writes a GeoJSON FeatureCollection to disk one feature at a time.
+
+    Features are appended to a temporary file next to the destination as they
+    are written, and the file is moved into place when the writer is closed,
+    so the destination never contains a partial collection.
+    """
+
+    def __init__(self, path, compress=None):
+        """
+        :param path: string
+        :param compress: list of codecs in COMPRESSION_EXTENSIONS to also write
+            compressed copies with
+        """
+        super(FeatureCollectionWriter, self).__init__()
+        self.path = path
+        self.file = OutputFile(path, compress)
+        self.file.write('{"type":"FeatureCollection","features":[')
+        self.count = 0
+
+    def write(self, feature):
+        """Append a feature to the collection.
+
+        :param feature: dict
+        """
+        if self.count > 0:
+            self.file.write(",")
+        self.file.write(dump_json(feature))
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self, members=None):
+        """Finish the collection and move it into place.
+
+        :param members: dict of additional top level members, eg. bbox
+        """
+        self.file.write("]")
+        for key, value in (members or {}).items():
+            self.file.write("," + dump_json(key) + ":" + dump_json(value))
+        self.file.write("}")
+        self.file.close()
+
+    def abort(self):
+        """Discard the collection, leaving the destination untouched. Does
+        nothing if the writer was already closed."""
+        self.file.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ExplodedWriter(object):
+    """Writes the exploded per feature files of a source into a directory.
+
+    The directory is a symbolic link to a version directory kept in
+    state_path, outside of the published tree. Files are written by a thread
+    pool into a new version directory. A file whose content hash matches the
+    previous version is hard linked from it instead of being rewritten. When
+    the writer is closed the link is replaced in a single rename to point to
+    the new version, and the previous versions are removed, so files that are
+    no longer produced are removed with them. Readers of the directory see
+    either all the previous files or all the new ones.
+
+    The content hashes of a version are kept next to it in state_path, so
+    they are not published with the files.
+    """
+
+    def __init__(self, path, state_path, threads=8):
+        """
+        :param path: string, path of the published directory
+        :param state_path: string, directory to keep the versions and their
+            content hashes in
+        :param threads: int, number of threads to write files in
+        """
+        super(ExplodedWriter, self).__init__()
+        self.path = path
+        self.state_path = state_path
+        self.version = uuid.uuid4().hex
+        self.staging_path = os.path.join(state_path, self.version)
+        os.makedirs(self.staging_path)
+
+        self.previous_path = None
+        self.previous_hashes = {}
+        if os.path.islink(path):
+            previous_version = os.path.basename(os.readlink(path))
+            index_path = self._get_index_path(previous_version)
+            if os.path.isfile(index_path):
+                self.previous_path = os.path.join(state_path, previous_version)
+                self.previous_hashes = read_json(index_path)
+        self.hashes = {}
+        self.written_count = 0
+        self.closed = False
+
+        self.pool = ThreadPool(threads)
+        # bound the number of serialized files waiting for a thread
+        self.pending = threading.BoundedSemaphore(threads * 4)
+        self.results = {}
+
+    def _get_index_path(self, version):
+        return os.path.join(self.state_path, version + ".json")
+
+    def write(self, filename, data):
+        """Queue data to be written as JSON to filename in the directory.
+
+        :param filename: string
+        :param data: object
+        """
+        content = dump_json(data).encode()
+        digest = hashlib.sha1(content).hexdigest()
+        if filename in self.results:
+            # a later write to the same file wins, as with sequential writes
+            self.results[filename].wait()
+        self.hashes[filename] = digest
+
+        self.pending.acquire()
+        self.results[filename] = self.pool.apply_async(
+            self._write,
+            (filename, content, digest),
+            callback=self._release,
+            error_callback=self._release,
+        )
+
+    def _release(self, result):
+        self.pending.release()
+
+    def _write(self, filename, content, digest):
+        staged = os.path.join(self.staging_path, filename)
+        if os.path.exists(staged):
+            os.remove(staged)
+        if self.previous_hashes.get(filename) == digest:
+            try:
+                os.link(os.path.join(self.previous_path, filename), staged)
+                return False
+            except OSError:
+                pass
+        with open(staged, "wb") as f:
+            f.write(content)
+        return True
+
+    def close(self):
+        """Wait for all files to be written, point the directory to them and
+        remove the previous versions. If a file could not be written, the new
+        version is discarded and the error raised."""
+        try:
+            self._publish()
+        except BaseException:
+            self.abort()
+            raise
+
+    def _publish(self):
+        self.pool.close()
+        self.pool.join()
+        # raises the error of a failed write, before the version is indexed
+        written = [r.get() for r in self.results.values()]
+        self.written_count = sum(1 for w in written if w)
+        write_json(self._get_index_path(self.version), self.hashes)
+
+        stale_count = len(set(self.previous_hashes) - set(self.hashes))
+        logging.info(
+            "%i files written, %i unchanged, %i removed in %s"
+            % (
+                self.written_count,
+                len(self.hashes) - self.written_count,
+                stale_count,
+                self.path,
+            )
+        )
+
+        link_path = self.path + ".tmp"
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        os.symlink(
+            os.path.relpath(self.staging_path, os.path.dirname(self.path)), link_path
         )
+        if os.path.isdir(self.path) and not os.path.islink(self.path):
+            # directories written before versions were kept can not be
+            # replaced by a link in a single rename
+            shutil.rmtree(self.path)
+        os.replace(link_path, self.path)
+        self.closed = True
+
+        index_name = os.path.basename(self._get_index_path(self.version))
+        for name in os.listdir(self.state_path):
+            if name in (self.version, index_name):
+                continue
+            old_path = os.path.join(self.state_path, name)
+            if os.path.isdir(old_path):
+                shutil.rmtree(old_path)
+            else:
+                os.remove(old_path)
+
+    def abort(self):
+        """Discard the staged files, leaving the existing directory untouched.
+        Does nothing if the writer was already closed."""
+        self.pool.terminate()
+        self.pool.join()
+        if self.closed:
+            return
+        if os.path.lexists(self.path + ".tmp"):
+            os.remove(self.path + ".tmp")
+        if os.path.exists(self.staging_path):
+            shutil.rmtree(self.staging_path)
+        if os.path.exists(self._get_index_path(self.version)):
+            os.remove(self._get_index_path(self.version))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
 
 
 def make_sure_path_exists(path):
@@ -74,9 +471,44 @@ def get_path_parts(path):
     return path.split(os.sep)
 
 
+def get_session(url):
+    """Returns the requests session for the host of a url. Sessions are shared
+    by the requests of a process, so connections to a host are reused.
+
+    :param url: string
+    :returns: requests.Session
+    """
+    # sessions are not shared with forked worker processes
+    key = (os.getpid(), urlparse(url).netloc)
+    session = _sessions.get(key)
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=POOL_MAXSIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _sessions[key] = session
+    return session
+
+
+def get_response_validators(res):
+    """Returns the HTTP validators (ETag, Last-Modified) of a response.
+
+    :param res: requests.Response
+    :returns: dict
+    """
+    return {h: res.headers[h] for h in VALIDATOR_HEADERS if h in res.headers}
+
+
 def download(url):
     """Downloads a file and returns a file pointer to a temporary file.
 
+    A file in the local download cache (see download_cache.DownloadCache) is
+    revalidated with a conditional request if the validators of its download
+    were stored, and returned as is otherwise.
+
+    The file pointer has a validators attribute, with the HTTP validators of
+    the download, as returned by get_response_validators.
+
     :param url: string
     """
     parsed_url = urlparse(url)
@@ -84,44 +516,73 @@ def download(url):
     urlfile = parsed_url.path.split("/")[-1]
     _, extension = os.path.split(urlfile)
 
-    fp = tempfile.NamedTemporaryFile("wb", suffix=extension, delete=False)
-
-    download_cache = os.getenv("DOWNLOAD_CACHE")
-    cache_path = None
-    if download_cache is not None:
-        cache_path = os.path.join(
-            download_cache, hashlib.sha224(url.encode()).hexdigest()
-        )
-        if os.path.exists(cache_path):
-            logging.info("Returning %s from local cache at %s" % (url, cache_path))
-            fp.close()
-            shutil.copy(cache_path, fp.name)
-            return fp
+    cache = get_download_cache()
+    cache_entry = None
+    cached_validators = {}
+    if cache is not None:
+        # download into the cache directory, so the file can be added to the
+        # cache and cache hits can be served without copying
+        fp = cache.create_download_file(suffix=extension)
+        cache_entry = cache.get(url)
+        if cache_entry is not None:
+            cached_validators = cache_entry["validators"]
+            if not cached_validators:
+                logging.info(
+                    "Returning %s from local cache at %s" % (url, cache_entry["path"])
+                )
+                if cache.checkout(cache_entry, fp.name):
+                    fp.close()
+                    fp.validators = {}
+                    return fp
+                cache_entry = None
+                cached_validators = {}
+    else:
+        fp = tempfile.NamedTemporaryFile("wb", suffix=extension, delete=False)
 
-    s3_cache_bucket = os.getenv("S3_CACHE_BUCKET")
-    s3_cache_key = None
-    if s3_cache_bucket is not None and s3_cache_bucket not in url:
-        s3_cache_key = (
-            os.getenv("S3_CACHE_PREFIX", "") + hashlib.sha224(url.encode()).hexdigest()
-        )
-        s3 = boto3.client("s3")
+    s3_cache = get_s3_cache()
+    if s3_cache is not None and (s3_cache.bucket in url or cached_validators):
+        s3_cache = None
+    if s3_cache is not None:
         try:
-            s3.download_fileobj(s3_cache_bucket, s3_cache_key, fp)
-            logging.info(
-                "Found %s in s3 cache at s3://%s/%s"
-                % (url, s3_cache_bucket, s3_cache_key)
-            )
+            s3_validators = _download_from_s3_cache(s3_cache, url, fp)
+        except (BotoCoreError, ClientError) as e:
+            logging.error("Unable to use s3 cache for %s: %s" % (url, e))
+            # the cache is skipped entirely, and not updated either
+            s3_cache = None
+            s3_validators = None
+            fp.seek(0)
+            fp.truncate()
+        if s3_validators is not None:
             fp.close()
+            if cache is not None:
+                cache.put(url, fp.name, s3_validators)
+            fp.validators = s3_validators
             return fp
-        except:
-            pass
 
+    validators = {}
     if parsed_url.scheme == "http" or parsed_url.scheme == "https":
-        res = requests.get(url, stream=True, verify=False)
+        headers = {
+            CONDITIONAL_HEADERS[h]: v for h, v in list(cached_validators.items())
+        }
+        res = get_session(url).get(url, stream=True, verify=False, headers=headers)
+
+        if res.status_code == 304 and cached_validators:
+            logging.info(
+                "%s is unchanged, returning it from local cache at %s"
+                % (url, cache_entry["path"])
+            )
+            res.close()
+            if cache.checkout(cache_entry, fp.name):
+                fp.close()
+                fp.validators = cached_validators
+                return fp
+            # evicted by another process since it was looked up
+            res = get_session(url).get(url, stream=True, verify=False)
 
         if not res.ok:
             raise IOError
 
+        validators = get_response_validators(res)
         for chunk in res.iter_content(CHUNK_SIZE):
             fp.write(chunk)
     elif parsed_url.scheme == "ftp":
@@ -139,21 +600,78 @@ def download(url):
 
     fp.close()
 
-    if cache_path:
-        if not os.path.exists(download_cache):
-            os.makedirs(download_cache)
-        shutil.copy(fp.name, cache_path)
+    if cache is not None:
+        cache.put(url, fp.name, validators)
 
-    if s3_cache_key:
-        logging.info(
-            "Putting %s to s3 cache at s3://%s/%s"
-            % (url, s3_cache_bucket, s3_cache_key)
-        )
-        s3.upload_file(fp.name, Bucket=s3_cache_bucket, Key=s3_cache_key)
+    if s3_cache is not None:
+        logging.info("Putting %s to s3 cache at %s" % (url, s3_cache.get_uri(url)))
+        try:
+            s3_cache.upload(url, fp.name, validators)
+        except (BotoCoreError, ClientError, S3UploadFailedError) as e:
+            logging.error("Failed to put %s to s3 cache: %s" % (url, e))
 
+    fp.validators = validators
     return fp
 
 
+def _download_from_s3_cache(s3_cache, url, fp):
+    """Download the copy of a url in the s3 cache to a file object, unless
+    it is missing or stale. Returns the validators of the copy, or None if it
+    was not downloaded.
+    """
+    entry = s3_cache.head(url)
+    if entry is None:
+        return None
+
+    # a copy with validators is stale if the upstream server reports others
+    if entry["validators"]:
+        upstream_validators = get_validators(url)
+        if upstream_validators and upstream_validators != entry["validators"]:
+            logging.info(
+                "Ignoring stale copy of %s in s3 cache at %s"
+                % (url, s3_cache.get_uri(url))
+            )
+            return None
+
+    s3_cache.download(url, fp)
+    fp.flush()
+    if os.path.getsize(fp.name) != entry["size"]:
+        logging.warning(
+            "Ignoring incomplete copy of %s in s3 cache at %s"
+            % (url, s3_cache.get_uri(url))
+        )
+        fp.seek(0)
+        fp.truncate()
+        return None
+
+    logging.info("Found %s in s3 cache at %s" % (url, s3_cache.get_uri(url)))
+    return entry["validators"]
+
+
+def get_validators(url):
+    """Returns the HTTP validators (ETag, Last-Modified) the server reports for
+    a url, without downloading it. Returns an empty dict if the url is not
+    HTTP or the server provides no validators.
+
+    :param url: string
+    :returns: dict
+    """
+    if urlparse(url).scheme not in ("http", "https"):
+        return {}
+
+    try:
+        res = get_session(url).head(
+            url, allow_redirects=True, verify=False, timeout=VALIDATOR_TIMEOUT
+        )
+    except requests.RequestException:
+        return {}
+
+    if not res.ok:
+        return {}
+
+    return get_response_validators(res)
+
+
 class ZipCompatibleTarFile(tarfile.TarFile):
     """Wrapper around TarFile to make it more compatible with ZipFile"""
 
@@ -168,37 +686,76 @@ class ZipCompatibleTarFile(tarfile.TarFile):
 
 
 ARCHIVE_FORMAT_ZIP = "zip"
+ARCHIVE_FORMAT_TAR = "tar"
 ARCHIVE_FORMAT_TAR_GZ = "tar.gz"
 ARCHIVE_FORMAT_TAR_BZ2 = "tar.bz2"
 
+# GDAL virtual file system and the file extension GDAL recognizes for archive
+# formats that can be read in place
+VSI_ARCHIVES = {
+    ARCHIVE_FORMAT_ZIP: ("zip", ".zip"),
+    ARCHIVE_FORMAT_TAR: ("tar", ".tar"),
+    ARCHIVE_FORMAT_TAR_GZ: ("tar", ".tar.gz"),
+}
+
+
+def get_archive_format(path):
+    """Returns the archive format of a file from its leading bytes, or None if
+    it is not a supported archive.
+
+    :param path: string
+    :returns: string, one of the ARCHIVE_FORMAT_* constants
+    """
+    with open(path, "rb") as f:
+        header = f.read(512)
+
+    if header.startswith(b"PK\x03\x04") or header.startswith(b"PK\x05\x06"):
+        return ARCHIVE_FORMAT_ZIP
+    elif header.startswith(b"\x1f\x8b"):
+        return ARCHIVE_FORMAT_TAR_GZ
+    elif header.startswith(b"BZh"):
+        return ARCHIVE_FORMAT_TAR_BZ2
+    elif header[257:262] == b"ustar":
+        return ARCHIVE_FORMAT_TAR
+    elif zipfile.is_zipfile(path):
+        # zip files with data prepended, eg. self extracting archives
+        return ARCHIVE_FORMAT_ZIP
+    return None
+
 
 def get_compressed_file_wrapper(path):
-    archive_format = None
-
-    if path.endswith(".zip"):
-        archive_format = ARCHIVE_FORMAT_ZIP
-    elif path.endswith(".tar.gz") or path.endswith(".tgz"):
-        archive_format = ARCHIVE_FORMAT_TAR_GZ
-    elif path.endswith(".tar.bz2"):
-        archive_format = ARCHIVE_FORMAT_TAR_BZ2
-    else:
-        try:
-            with zipfile.ZipFile(path, "r") as f:
-                archive_format = ARCHIVE_FORMAT_ZIP
-        except:
-            try:
-                f = tarfile.TarFile.open(path, "r")
-                f.close()
-                archive_format = ARCHIVE_FORMAT_ZIP
-            except:
-                pass
+    archive_format = get_archive_format(path)
 
     if archive_format is None:
         raise Exception("Unable to determine archive format")
 
     if archive_format == ARCHIVE_FORMAT_ZIP:
         return zipfile.ZipFile(path, "r")
+    elif archive_format == ARCHIVE_FORMAT_TAR:
+        return ZipCompatibleTarFile.open(path, "r:")
     elif archive_format == ARCHIVE_FORMAT_TAR_GZ:
         return ZipCompatibleTarFile.open(path, "r:gz")
     elif archive_format == ARCHIVE_FORMAT_TAR_BZ2:
         return ZipCompatibleTarFile.open(path, "r:bz2")
+
+
+def get_archive_vsi(path):
+    """Returns the GDAL virtual file system and file extension to read an
+    archive in place with, or None if its format can not be read in place.
+
+    :param path: string
+    :returns: tuple of strings
+    """
+    return VSI_ARCHIVES.get(get_archive_format(path))
+
+
+def extract_members(path, names, directory):
+    """Extract some members of an archive.
+
+    :param path: string, path of the archive
+    :param names: list of member names to extract
+    :param directory: string, directory to extract to
+    """
+    with closing(get_compressed_file_wrapper(path)) as archive:
+        for name in names:
+            archive.extract(name, directory)